@@ -1,23 +1,58 @@
 from flask_cors import CORS
-from flask import Flask, render_template, jsonify, redirect, url_for, request
+from flask import Flask, render_template, jsonify, redirect, url_for, request, Response
 import datamgr as dm
+from content import source
 
 app = Flask(__name__)
 # enable CORS for the econdata endpoint so the frontend dev server can call it
 CORS(app, resources={r"/econdata": {"origins": "*"}})
 
 
+@app.errorhandler(dm.BadRequest)
+def bad_request(e):
+    return jsonify({'error': str(e)}), 400
+
+@app.errorhandler(source.RequestsFailed)
+def requests_failed(e):
+    return jsonify({'error': 'Upstream requests failed'}), 502
+
+# request body as a JSON object, malformed bodies are a bad request
+def request_json():
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        raise dm.BadRequest('Request body must be a JSON object')
+    return data
+
+
 @app.route('/econdata', methods=['POST'])
 def econdata():
-    data = request.get_json()
+    data = request_json()
+    series_ids = [x for x in data.get("series_ids", []) if x != '']
+
+    # encoding 'orjson' is opt-in, the default is the compact streaming encoder
+    encoding = data.get("encoding", "compact")
+
+    # series are computed before streaming so errors still return a status code.
+    # start/end and max_points only shape the response, the cache keeps full resolution
+    frames = dm.window_frames(dm.econ_series(series_ids, dm.request_trans(data)), **dm.window_params(data))
+
+    return Response(dm.stream_series(frames, encoding), mimetype='application/json')
+
+# series aligned on one date axis, optionally cut to a start/end window
+# and downsampled to max_points per series
+@app.route('/econdata/aligned', methods=['POST'])
+def econdata_aligned():
+    data = request_json()
     series_ids = [x for x in data.get("series_ids", []) if x != '']
+    encoding = data.get("encoding", "compact")
 
-    obj = dm.EconData(series_ids)
-    obj.apply_transformations()
+    payload = dm.econ_aligned(series_ids, dm.request_trans(data), encoding=encoding, **dm.window_params(data))
 
-    api = obj.api_json()
+    return Response(payload, mimetype='application/json')
 
-    return jsonify(api)
+@app.route('/econdata/cache', methods=['GET'])
+def econdata_cache():
+    return jsonify(dm.payload_cache.stats())
 
 if __name__=="__main__":
     app.run(debug=True)
@@ -0,0 +1,142 @@
+#ASGI serving mode for the econdata endpoints. Requests are handled as
+#coroutines: the FRED requests of all series fan out concurrently on the
+#shared loop and database and pandas work runs in worker threads.
+#Run with any ASGI server, e.g. uvicorn asgi:app
+import json
+import asyncio
+import datamgr as dm
+from content import source
+
+cors_headers = [(b'access-control-allow-origin', b'*'),
+                (b'access-control-allow-methods', b'GET, POST, OPTIONS'),
+                (b'access-control-allow-headers', b'content-type')]
+
+
+async def read_body(receive):
+    body = b''
+    more_body = True
+    while more_body:
+        message = await receive()
+        body += message.get('body', b'')
+        more_body = message.get('more_body', False)
+    return body
+
+#Request body as a JSON object, malformed bodies are a bad request
+async def read_json(receive):
+    try:
+        data = json.loads(await read_body(receive) or b'{}')
+    except ValueError:
+        raise dm.BadRequest('Request body is not valid JSON')
+    if not isinstance(data, dict):
+        raise dm.BadRequest('Request body must be a JSON object')
+    return data
+
+async def start_response(send, status:int, content_type:bytes=b'application/json'):
+    await send({'type': 'http.response.start',
+                'status': status,
+                'headers': [(b'content-type', content_type)] + cors_headers})
+
+async def send_json(send, status:int, payload):
+    await start_response(send, status)
+    await send({'type': 'http.response.body', 'body': json.dumps(payload).encode()})
+
+
+#Chunks of a blocking generator, each one produced in a worker thread so
+#encoding does not hold up the other requests on the loop
+async def chunks_in_thread(chunks):
+    done = object()
+    while True:
+        chunk = await asyncio.to_thread(next, chunks, done)
+        if chunk is done:
+            return
+        yield chunk
+
+#Series of the request cut to its window, windowing and downsampling run
+#in a worker thread
+async def request_frames(data, series_ids):
+    series = await dm.async_econ_series(series_ids, dm.request_trans(data))
+    return await asyncio.to_thread(dm.window_frames, series, **dm.window_params(data))
+
+
+async def econdata(scope, receive, send):
+    data = await read_json(receive)
+    series_ids = [x for x in data.get("series_ids", []) if x != '']
+
+    # encoding 'orjson' is opt-in, the default is the compact streaming encoder
+    encoding = data.get("encoding", "compact")
+
+    # series are computed before streaming so errors still return a status code
+    frames = await request_frames(data, series_ids)
+
+    await start_response(send, 200)
+    async for chunk in chunks_in_thread(dm.stream_series(frames, encoding)):
+        await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+    await send({'type': 'http.response.body', 'body': b''})
+
+# series aligned on one date axis, optionally cut to a start/end window
+# and downsampled to max_points per series
+async def econdata_aligned(scope, receive, send):
+    data = await read_json(receive)
+    series_ids = list(dict.fromkeys(x for x in data.get("series_ids", []) if x != ''))
+    encoding = data.get("encoding", "compact")
+
+    frames = await request_frames(data, series_ids)
+    payload = await asyncio.to_thread(dm.encode_aligned, frames, encoding)
+
+    await start_response(send, 200)
+    await send({'type': 'http.response.body', 'body': payload})
+
+async def econdata_cache(scope, receive, send):
+    await send_json(send, 200, dm.payload_cache.stats())
+
+routes = {('POST', '/econdata'): econdata,
+          ('POST', '/econdata/aligned'): econdata_aligned,
+          ('GET', '/econdata/cache'): econdata_cache}
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+async def app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        return await lifespan(receive, send)
+
+    if scope['type'] != 'http':
+        #websocket and other scope types are not served
+        return
+
+    if scope['method'] == 'OPTIONS':
+        await start_response(send, 204)
+        await send({'type': 'http.response.body', 'body': b''})
+        return
+
+    handler = routes.get((scope['method'], scope['path']))
+    if handler is None:
+        return await send_json(send, 404, {'error': 'Not found'})
+
+    started = False
+    async def tracked_send(message):
+        nonlocal started
+        if message['type'] == 'http.response.start':
+            started = True
+        await send(message)
+
+    try:
+        await handler(scope, receive, tracked_send)
+    except Exception as e:
+        print('Error serving', scope['path'], e)
+        if started:
+            #the status is already sent, end the body so the client sees a truncated response
+            await send({'type': 'http.response.body', 'body': b''})
+        elif isinstance(e, dm.BadRequest):
+            await send_json(send, 400, {'error': str(e)})
+        elif isinstance(e, source.RequestsFailed):
+            await send_json(send, 502, {'error': 'Upstream requests failed'})
+        else:
+            await send_json(send, 500, {'error': 'Internal server error'})
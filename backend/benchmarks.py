@@ -0,0 +1,522 @@
+#Benchmarks for the heavier data paths of the backend
+#Usage: python benchmarks.py <name> [args]
+import os
+import sys
+import time
+import json
+import asyncio
+import threading
+import tracemalloc
+import pickle
+import re
+from urllib.parse import urlparse, parse_qs
+from concurrent.futures import ThreadPoolExecutor
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import aiohttp
+import numpy as np
+import pandas as pd
+import datamgr as dm
+from content import source
+from content import eod
+from content import fred
+from content.admin import Database, frame_records
+
+
+#Function to time a callable, returns the best of the repeats in seconds
+def timed(func, repeat=3):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+#Function to build a wide monthly frame like EconData.historical_data
+def synthetic_econ(n_series:int, periods:int=600):
+    dates = pd.date_range('1975-01-01', periods=periods, freq='MS')
+    values = np.random.default_rng(0).lognormal(size=(periods, n_series)).cumsum(axis=0)
+    frame = pd.DataFrame(values, columns=[f'S{i}' for i in range(n_series)])
+    frame.insert(0, 'date', dates)
+    return frame
+
+
+#Per column merge loop of Transformations.Changes against batch_changes
+def bench_transformations(*sizes):
+    sizes = [int(x) for x in sizes] or [10, 100, 500, 1000]
+    trans = ['YoY', 'QoQ', 'MoM']
+    print(f'{"series":>8} {"per column (s)":>16} {"batched (s)":>12} {"speedup":>8}')
+
+    for n in sizes:
+        frame = synthetic_econ(n)
+        columns = [x for x in frame.columns if x != 'date']
+
+        def per_column():
+            obj = dm.Transformations()
+            for col in columns:
+                setattr(obj, col, frame[['date', col]])
+            for tran in trans:
+                for col in columns:
+                    obj.Changes(frame, 'date', col, col, freq=tran)
+
+        def batched():
+            obj = dm.Transformations()
+            pd.concat([frame, obj.batch_changes(frame, 'date', columns, trans)], axis=1)
+
+        repeat = 1 if n > 100 else 3
+        old = timed(per_column, repeat)
+        new = timed(batched, repeat)
+        print(f'{n:>8} {old:>16.3f} {new:>12.3f} {old / new:>7.1f}x')
+
+
+#Keep-alive JSON server counting the TCP connections it accepts
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    connections = 0
+    body = json.dumps({'observations': [{'date': '2020-01-01', 'value': '1.0'}] * 50}).encode()
+
+    def setup(self):
+        MockHandler.connections += 1
+        BaseHTTPRequestHandler.setup(self)
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(self.body)))
+        self.end_headers()
+        self.wfile.write(self.body)
+
+    def log_message(self, *args):
+        pass
+
+def mock_server(handler=MockHandler):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f'http://127.0.0.1:{server.server_address[1]}'
+
+
+#New loop and session per call (previous BaseRequests) against the shared
+#client, requests go through a Scheduler that does not throttle the mock
+def bench_http(calls=50, batch=10):
+    calls = int(calls)
+    batch = int(batch)
+    server, url = mock_server()
+    params = {i: (url + '/series/observations', {'series_id': str(i)}) for i in range(batch)}
+
+    async def fetch(session, url_, payload):
+        async with session.get(url_, params=payload) as response:
+            return await response.json()
+
+    async def per_call_session():
+        async with aiohttp.ClientSession() as session:
+            return await asyncio.gather(*[fetch(session, url_, payload) for url_, payload in params.values()])
+
+    def old():
+        for _ in range(calls):
+            asyncio.run(per_call_session())
+
+    req = source.BaseRequests()
+    req.scheduler = source.Scheduler(rate=10**6, concurrency=batch)
+    req.cache = source.ResponseCache(None)
+
+    def new():
+        for _ in range(calls):
+            req.select_request(params)
+
+    print(f'{calls} calls of {batch} requests')
+    for name, func in [('new loop + session per call', old), ('shared client', new)]:
+        MockHandler.connections = 0
+        elapsed = timed(func, 1)
+        print(f'{name:>30}: {elapsed:.3f}s, {MockHandler.connections} connections')
+
+    server.shutdown()
+
+
+#Database object pointed at a local Postgres through the PG* variables
+def local_database(table_name, constraints):
+    obj = Database(table_name, constraints)
+    obj.host = os.environ.get('PGHOST', 'localhost')
+    obj.database = os.environ.get('PGDATABASE', 'postgres')
+    obj.user = os.environ.get('PGUSER', 'postgres')
+    obj.password = os.environ.get('PGPASSWORD', '')
+    obj.port = os.environ.get('PGPORT', '5432')
+    obj.conn_string = f'postgresql://{obj.user}:{obj.password}@{obj.host}/{obj.database}'
+    obj.alt_conn_string = f'host={obj.host} dbname={obj.database} user={obj.user} password={obj.password} port={obj.port}'
+    return obj
+
+#Function to build a long price frame like Historical.data
+def synthetic_prices(n_symbols:int, days:int):
+    dates = pd.date_range('2000-01-03', periods=days, freq='B').strftime('%Y-%m-%d')
+    rng = np.random.default_rng(0)
+    n = n_symbols * days
+    frame = pd.DataFrame({'date': np.tile(dates, n_symbols),
+                          'open': rng.random(n),
+                          'high': rng.random(n),
+                          'low': rng.random(n),
+                          'close': rng.random(n),
+                          'adjusted_close': rng.random(n),
+                          'volume': rng.integers(0, 10**7, n),
+                          'symbol': np.repeat([f'S{i}' for i in range(n_symbols)], days)})
+    return frame
+
+
+#Multi-row INSERT, executemany and COPY + merge upserts on a local Postgres
+def bench_upsert(rows=200000):
+    rows = int(rows)
+    frame = synthetic_prices(max(1, rows // 2500), 2500)
+
+    obj = local_database('bench_upsert', ['date', 'symbol'])
+    obj.columns = frame.columns
+    obj.dtypes = frame.dtypes.items()
+    obj.raw_data = frame_records(frame)
+
+    with obj.connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(f'DROP TABLE IF EXISTS {obj.table_name};')
+        conn.commit()
+    obj.create_table()
+
+    paths = [('INSERT ... VALUES (mogrify)', obj.upsert_exec),
+             ('executemany', lambda: obj.upsert_async(copy=False)),
+             ('COPY + merge', lambda: obj.upsert_async(copy=True))]
+
+    print(f'{len(frame)} rows, second run updates every row')
+    for name, func in paths:
+        first = timed(func, 1)
+        second = timed(func, 1)
+        print(f'{name:>28}: insert {first:.2f}s, update {second:.2f}s')
+
+
+#Raw EOD responses for many symbols, as returned by EODData.historical
+def synthetic_eod(n_symbols:int, days:int):
+    dates = pd.date_range('1995-01-02', periods=days, freq='B').strftime('%Y-%m-%d').tolist()
+    raw = {}
+    for i in range(n_symbols):
+        raw[f'S{i}'] = [{'date': d, 'open': 1.0 + j, 'high': 2.0 + j, 'low': 0.5 + j, 'close': 1.5 + j,
+                         'adjusted_close': 1.4 + j, 'volume': 1000 + j} for j, d in enumerate(dates)]
+    return raw
+
+#Previous Historical.data: prep_raw row copies and a pd.concat per symbol
+def concat_frame(raw_data):
+    rows = []
+    for _ in raw_data:
+        for entry in raw_data[_]:
+            temp = dict(entry)
+            temp['symbol'] = _
+            rows.append(temp)
+
+    frame = pd.DataFrame()
+    for _ in raw_data:
+        temp = pd.DataFrame(raw_data[_])
+        temp['symbol'] = _
+        frame = pd.concat([frame, temp])
+    return frame, [tuple(x.values()) for x in rows]
+
+def columnar_frame(raw_data):
+    obj = eod.Historical.__new__(eod.Historical)
+    obj.price_cols = ['open', 'high', 'low', 'close', 'adjusted_close']
+    obj.buffers = obj.build_columns(raw_data)
+    obj.columns = list(obj.buffers)
+    dates = np.array(obj.buffers['date'], dtype='datetime64[D]').astype('datetime64[ns]')
+    frame = pd.DataFrame({**obj.buffers, 'date': dates}, copy=False)
+    return frame, obj.gather_values()
+
+
+#Time and peak memory of the frame and upsert records for a synthetic payload
+def bench_frame_builder(n_symbols=1000, days=2500):
+    raw = synthetic_eod(int(n_symbols), int(days))
+    print(f'{n_symbols} symbols x {days} days')
+
+    for name, func in [('concat loop', concat_frame), ('columnar', columnar_frame)]:
+        tracemalloc.start()
+        start = time.perf_counter()
+        func(raw)
+        elapsed = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        print(f'{name:>12}: {elapsed:.2f}s, peak {peak / 1024**2:.0f} MiB')
+
+
+#Bulk fundamentals response with fields starting with digits like the real payload
+def synthetic_bulk(n_symbols:int=450):
+    raw = {}
+    for i in range(n_symbols):
+        raw[str(i)] = {'General': {'Code': f'S{i}', 'Name': f'Name {i}', 'Exchange': 'US'},
+                       'Highlights': {f'{k}Field{k}': float(k) for k in range(60)},
+                       'Valuation': {f'Ratio{k}': float(k) for k in range(20)},
+                       'Technicals': {f'{k}DayMA': float(k) for k in range(30)},
+                       'SplitsDividends': {'PayoutRatio': 0.5, 'LastSplitDate': '2020-01-01'}}
+    return raw
+
+#Previous BulkFund.data: uncompiled re.match for every key of every entry, twice
+def regex_per_key(raw_data, sets):
+    def move_integers_to_end(x):
+        match = re.match(r'(\d+)(.*)', x)
+        return match.group(2) + match.group(1) if match else x
+
+    dic = {x: [] for x in sets}
+    for _ in raw_data:
+        code = raw_data[_]['General']['Code']
+        for subset in raw_data[_]:
+            if subset in sets:
+                temp = dict(raw_data[_][subset])
+                temp['Code'] = code
+                dic[subset].append(temp)
+
+    for subset in dic:
+        frame = pd.DataFrame(dic[subset])
+        columns = [move_integers_to_end(x) for x in frame.columns]
+        rows = []
+        for entry in dic[subset]:
+            alt_entry = dict(zip([move_integers_to_end(x) for x in entry.keys()], entry.values()))
+            rows.append({col: alt_entry.get(col) for col in columns})
+    return dic
+
+#Renaming on a recorded bulk fundamentals response (JSON of the 'bulk' payload)
+#or on a synthetic one
+def bench_field_names(path=None):
+    if path is None:
+        raw = synthetic_bulk()
+    else:
+        with open(path) as f:
+            raw = json.load(f)
+        raw = raw.get('bulk', raw)
+    sets = ['General', 'Valuation', 'Highlights', 'Technicals', 'SplitsDividends']
+
+    def cached():
+        eod.rename_keys.cache_clear()
+        eod.normalize(eod.bulk_rows, raw, sets, workers=1)
+
+    old = timed(lambda: regex_per_key(raw, sets))
+    new = timed(cached)
+    print(f'{len(raw)} entries: per key regex {old:.3f}s, cached key tuples {new:.3f}s, {old / new:.1f}x')
+
+
+#Parsing bulk fundamentals in process against sharding them across the
+#parse pool. The pickling round trip of the shards and of the normalized
+#results is timed apart, the pool only pays off when it is well below the
+#in-process parse time
+def bench_parse_pool(n_symbols=2000, workers=4):
+    raw = synthetic_bulk(int(n_symbols))
+    workers = int(workers)
+    sets = ['General', 'Valuation', 'Highlights', 'Technicals', 'SplitsDividends']
+
+    items = list(raw.items())
+    parts = [dict(items[i::workers]) for i in range(workers)]
+    results = [eod.normalize_shard(eod.bulk_rows, part, sets) for part in parts]
+
+    def round_trip():
+        pickle.loads(pickle.dumps(parts, protocol=pickle.HIGHEST_PROTOCOL))
+        pickle.loads(pickle.dumps(results, protocol=pickle.HIGHEST_PROTOCOL))
+
+    #warm up the spawned workers before timing
+    eod.normalize(eod.bulk_rows, raw, sets, workers=workers, shard_min=1)
+
+    in_process = timed(lambda: eod.normalize(eod.bulk_rows, raw, sets, workers=1))
+    pickling = timed(round_trip)
+    pooled = timed(lambda: eod.normalize(eod.bulk_rows, raw, sets, workers=workers, shard_min=1))
+    print(f'{len(raw)} entries, {workers} workers')
+    print(f'{"in process":>22}: {in_process:.3f}s')
+    print(f'{"shard pickle round trip":>22}: {pickling:.3f}s')
+    print(f'{"process pool":>22}: {pooled:.3f}s, {in_process / pooled:.1f}x')
+
+
+#Stub of the FRED endpoints used by EconData, answers after a fixed latency
+class StubFREDHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    latency = 0.02
+    observations = json.dumps({'observations': [{'realtime_start': '2024-01-01', 'realtime_end': '2024-01-01',
+                                                 'date': x.strftime('%Y-%m-%d'), 'value': str(100 + i)}
+                                                for i, x in enumerate(pd.date_range('1975-01-01', periods=600, freq='MS'))]}).encode()
+
+    def body(self, path, series_id):
+        if path.endswith('/series/observations'):
+            return self.observations
+        elif path.endswith('/series/release'):
+            return json.dumps({'releases': [{'id': 10, 'name': 'Release', 'press_release': True, 'link': ''}]}).encode()
+        elif path.endswith('/series'):
+            return json.dumps({'seriess': [{'id': series_id, 'title': series_id, 'frequency': 'Monthly',
+                                            'last_updated': '2024-01-01'}]}).encode()
+        return None
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        body = self.body(url.path, parse_qs(url.query).get('series_id', [''])[0])
+        time.sleep(self.latency)
+
+        self.send_response(200 if body is not None else 404)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body or b'')))
+        self.end_headers()
+        self.wfile.write(body or b'')
+
+    def log_message(self, *args):
+        pass
+
+#Previous request path: the three endpoint groups requested one after another
+def serve_sequential(series_ids):
+    obj = dm.EconData(series_ids, read_through=False, load=False)
+    raw_data = fred.Observations(series_ids).data()
+    obj.meta_data = fred.SeriesMeta(series_ids).data()
+    obj._release_data = fred.SeriesRelease(series_ids).data()
+    obj.build_frames(raw_data)
+    obj.apply_transformations()
+    return b''.join(dm.stream_series(obj.series_frames()))
+
+def serve_sync(series_ids):
+    obj = dm.EconData(series_ids, read_through=False)
+    obj.apply_transformations()
+    return b''.join(dm.stream_series(obj.series_frames()))
+
+async def serve_async(series_ids):
+    obj = await dm.EconData.create(series_ids, read_through=False)
+    await asyncio.to_thread(obj.apply_transformations)
+    return await asyncio.to_thread(lambda: b''.join(dm.stream_series(obj.series_frames())))
+
+def latency_report(name, latencies, elapsed):
+    latencies = np.sort(np.array(latencies))
+    print(f'{name:>22}: {len(latencies) / elapsed:8.1f} req/s, '
+          f'p50 {np.percentile(latencies, 50) * 1000:8.1f}ms, p99 {np.percentile(latencies, 99) * 1000:8.1f}ms')
+
+#Load test of the econdata request path against a stub FRED server, without
+#the local store. Threaded workers (Flask) against coroutines (ASGI)
+def bench_serving(requests=200, concurrency=20, n_series=5, latency_ms=20):
+    requests = int(requests)
+    concurrency = int(concurrency)
+    n_series = int(n_series)
+    StubFREDHandler.latency = int(latency_ms) / 1000
+
+    server, url = mock_server(StubFREDHandler)
+    source.FREDData.main_url = url + '/fred'
+    #the connection cap of the shared client would bound every mode alike
+    client = source.Client(limit=500, limit_per_host=500)
+    source.schedulers['FRED'] = source.Scheduler(rate=100000, burst=100000, concurrency=500, http=client)
+    jobs = [[f'S{i}_{j}' for j in range(n_series)] for i in range(requests)]
+
+    def threaded(serve):
+        def timed_call(series_ids):
+            start = time.perf_counter()
+            serve(series_ids)
+            return time.perf_counter() - start
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(concurrency) as executor:
+            latencies = list(executor.map(timed_call, jobs))
+        return latencies, time.perf_counter() - start
+
+    #Worst delay of a 10ms timer while requests are served, how long other
+    #requests on the loop would wait
+    async def loop_lag(stop):
+        worst = 0
+        while not stop.is_set():
+            start = time.perf_counter()
+            await asyncio.sleep(0.01)
+            worst = max(worst, time.perf_counter() - start - 0.01)
+        return worst
+
+    async def coroutines():
+        semaphore = asyncio.Semaphore(concurrency)
+        stop = asyncio.Event()
+        lag = asyncio.create_task(loop_lag(stop))
+
+        async def timed_call(series_ids):
+            async with semaphore:
+                start = time.perf_counter()
+                await serve_async(series_ids)
+                return time.perf_counter() - start
+
+        start = time.perf_counter()
+        latencies = await asyncio.gather(*[timed_call(x) for x in jobs])
+        elapsed = time.perf_counter() - start
+        stop.set()
+        print(f'{"asgi loop lag":>22}: {await lag * 1000:8.1f}ms worst')
+        return latencies, elapsed
+
+    print(f'{requests} requests of {n_series} series, {concurrency} concurrent, {latency_ms}ms upstream latency')
+    latency_report('threads, sequential', *threaded(serve_sequential))
+    latency_report('threads, fan out', *threaded(serve_sync))
+    latency_report('asgi, fan out', *asyncio.run(coroutines()))
+
+    client.close()
+    server.shutdown()
+
+
+#Previous OverlayData alignment: left merges onto a daily calendar grid
+def daily_grid(econ_data, market_data):
+    min_date = min(econ_data.index.min(), market_data.index.min())
+    max_date = max(econ_data.index.max(), market_data.index.max())
+    frame = pd.DataFrame(index=pd.date_range(start=min_date, end=max_date, freq='D'))
+    frame = frame.merge(econ_data, left_index=True, right_index=True, how='left')
+    frame = frame.merge(market_data, left_index=True, right_index=True, how='left')
+    frame.index.name = 'date'
+    return frame.reset_index()
+
+#Daily grid against the union and as-of alignments of OverlayData
+def bench_overlay(n_series=20, n_symbols=20):
+    n_series = int(n_series)
+    n_symbols = int(n_symbols)
+    econ_data = synthetic_econ(n_series, periods=1500).set_index('date')
+    days = pd.bdate_range('1990-01-01', '2024-12-31')
+    market_data = pd.DataFrame(np.random.default_rng(1).lognormal(size=(len(days), n_symbols)),
+                               index=days, columns=[f'M{i}' for i in range(n_symbols)])
+    market_data.index.name = 'date'
+
+    obj = dm.OverlayData.__new__(dm.OverlayData)
+    obj.fill, obj.fill_limit, obj.tolerance = None, None, None
+
+    def aligned(align, fill=None):
+        obj.alignment, obj.fill = align, fill
+        return obj.align(econ_data, market_data)
+
+    print(f'{n_series} monthly series since {econ_data.index.min().year}, {n_symbols} daily symbols')
+    for name, func in [('daily grid', lambda: daily_grid(econ_data, market_data)),
+                       ('union', lambda: aligned('union')),
+                       ('union, ffill', lambda: aligned('union', 'ffill')),
+                       ('as of market dates', lambda: aligned('market'))]:
+        frame = func()
+        print(f'{name:>20}: {timed(func):.3f}s, {len(frame):>7} rows, {frame.memory_usage(deep=True).sum() / 1024**2:7.1f} MB')
+
+
+#pandas rolling calls over the whole frame against rolling_stats, one
+#statistic at a time and all of them in one call
+def bench_rolling(n_series=200, window=24):
+    n_series = int(n_series)
+    window = int(window)
+    frame = synthetic_econ(n_series, periods=5000)
+    columns = [x for x in frame.columns if x != 'date']
+    values = frame[columns]
+    base = columns[0]
+    obj = dm.Transformations()
+
+    #pandas over the whole frame at once for each statistic
+    pandas_stats = {f'RollMean{window}': lambda: values.rolling(window).mean(),
+                    f'ZScore{window}': lambda: (values - values.rolling(window).mean()) / values.rolling(window).std(),
+                    f'RollVol{window}': lambda: values.pct_change(fill_method=None).rolling(window).std(),
+                    'Drawdown': lambda: values / values.cummax() - 1,
+                    f'RollCorr{window}:{base}': lambda: values.pct_change(fill_method=None).rolling(window).corr(values[base].pct_change(fill_method=None))}
+
+    print(f'{n_series} columns x {len(frame)} rows')
+    print(f'{"statistic":>16} {"pandas (s)":>11} {"rolling_stats (s)":>18} {"speedup":>8}')
+    for name, func in list(pandas_stats.items()) + [('all', None)]:
+        if func is None:
+            old = timed(lambda: [x() for x in pandas_stats.values()])
+            new = timed(lambda: obj.rolling_stats(frame, columns, list(pandas_stats)))
+        else:
+            old = timed(func)
+            new = timed(lambda: obj.rolling_stats(frame, columns, [name]))
+        print(f'{name:>16} {old:>11.3f} {new:>18.3f} {old / new:>7.1f}x')
+
+
+benchmarks = {'transformations': bench_transformations,
+              'http': bench_http,
+              'upsert': bench_upsert,
+              'frame_builder': bench_frame_builder,
+              'field_names': bench_field_names,
+              'parse_pool': bench_parse_pool,
+              'serving': bench_serving,
+              'overlay': bench_overlay,
+              'rolling': bench_rolling}
+
+if __name__ == '__main__':
+    name = sys.argv[1] if len(sys.argv) > 1 else 'transformations'
+    benchmarks[name](*sys.argv[2:])
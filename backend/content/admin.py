@@ -5,13 +5,19 @@ from sqlalchemy import Integer, String, Float, Boolean, DateTime, UniqueConstrai
 from sqlalchemy.dialects.postgresql import insert
 from sqlalchemy.ext.declarative import declarative_base
 import psycopg2 as sql
+from psycopg2 import extensions, pool as sql_pool
 import asyncpg
 import asyncio
-import nest_asyncio
+import threading
+import atexit
+import time
+import copy
+import datetime
+import functools
+from contextlib import contextmanager
+from collections import OrderedDict
 from . import secret
 
-nest_asyncio.apply()
-
 import smtplib
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
@@ -52,8 +58,303 @@ def convert_dates(date_code):
         return wrapper
     return convert_dates_arg
 
+#Function to turn a dataframe into upsert-ready records
+#(NaN/NaT become None and numpy scalars become python types)
+def frame_records(frame):
+    frame = frame.astype(object).where(frame.notnull(), None)
+    return frame.to_dict(orient='records')
+
+#Process wide connection pools shared by every Database and Views object.
+#Pools are keyed by connection string so objects pointed at other servers
+#get their own pool
+class ConnectionManager:
+    def __init__(self, min_size=1, max_size=10, ping_after=30):
+        self.min_size = min_size
+        self.max_size = max_size
+        self.ping_after = ping_after
+        self.engines = {}
+        self.sync_pools = {}
+        self.async_pools = {}
+        self.slots = {}
+        self.last_used = {}
+        self.lock = threading.Lock()
+
+    #SQLAlchemy engine, pre-ping checks connections before they are used
+    def engine(self, conn_string):
+        with self.lock:
+            if conn_string not in self.engines:
+                self.engines[conn_string] = create_engine(conn_string,
+                                                          pool_size=self.max_size,
+                                                          max_overflow=0,
+                                                          pool_pre_ping=True,
+                                                          pool_recycle=1800)
+            return self.engines[conn_string]
+
+    def sync_pool(self, dsn):
+        with self.lock:
+            if dsn not in self.sync_pools:
+                self.sync_pools[dsn] = sql_pool.ThreadedConnectionPool(self.min_size, self.max_size, dsn)
+                #getconn raises PoolError once max_size connections are out,
+                #callers wait on the semaphore for a free slot instead
+                self.slots[dsn] = threading.BoundedSemaphore(self.max_size)
+            return self.sync_pools[dsn], self.slots[dsn]
+
+    #Connections idle for longer than ping_after are checked before reuse
+    def healthy(self, conn):
+        if conn.closed != 0 or conn.get_transaction_status() == extensions.TRANSACTION_STATUS_UNKNOWN:
+            return False
+        if time.monotonic() - self.last_used.get(id(conn), 0) < self.ping_after:
+            return True
+        try:
+            with conn.cursor() as cur:
+                cur.execute('SELECT 1;')
+            conn.rollback()
+            return True
+        except sql.Error:
+            return False
+
+    #psycopg2 connection checked out of the pool. Commits on success and
+    #rolls back on error, like using the connection as a context manager
+    @contextmanager
+    def connection(self, dsn):
+        pool, slots = self.sync_pool(dsn)
+        slots.acquire()
+        try:
+            conn = pool.getconn()
+            while not self.healthy(conn):
+                self.put(pool, conn, close=True)
+                conn = pool.getconn()
+
+            try:
+                yield conn
+                conn.commit()
+            except Exception:
+                if conn.closed == 0:
+                    conn.rollback()
+                raise
+            finally:
+                self.put(pool, conn, close=conn.closed != 0)
+        finally:
+            slots.release()
+
+    #Return a connection to the pool. ids are reused once a connection is
+    #garbage collected so closed connections drop their entry
+    def put(self, pool, conn, close=False):
+        if close == True:
+            self.last_used.pop(id(conn), None)
+        else:
+            self.last_used[id(conn)] = time.monotonic()
+        pool.putconn(conn, close=close)
+
+    #asyncpg pool, lives on the shared event loop. The creation task is
+    #stored before awaiting so concurrent callers share one pool
+    async def async_pool(self, user, password, database, host, port):
+        key = (user, database, host, port)
+        if key not in self.async_pools:
+            self.async_pools[key] = asyncio.ensure_future(asyncpg.create_pool(user=user, password=password,
+                                                                              database=database, host=host, port=int(port),
+                                                                              min_size=self.min_size, max_size=self.max_size,
+                                                                              max_inactive_connection_lifetime=300))
+        task = self.async_pools[key]
+        try:
+            return await asyncio.shield(task)
+        except Exception:
+            if self.async_pools.get(key) is task:
+                del self.async_pools[key]
+            raise
+
+    async def close_async(self):
+        for key in list(self.async_pools):
+            try:
+                pool = await self.async_pools.pop(key)
+            except Exception:
+                continue
+            await pool.close()
+
+    def close(self):
+        with self.lock:
+            for engine in self.engines.values():
+                engine.dispose()
+            for pool in self.sync_pools.values():
+                pool.closeall()
+            self.engines = {}
+            self.sync_pools = {}
+            self.slots = {}
+            self.last_used = {}
+
+        if len(self.async_pools) > 0:
+            source.run(self.close_async())
+        return True
+
+#Tables and columns known to exist in each database, read from
+#information_schema once per process and kept up to date by create_table
+class SchemaRegistry:
+    def __init__(self):
+        self.tables = {}
+        self.types = {}
+        self.partitions = {}
+        self.lock = threading.Lock()
+
+    def load(self, db):
+        dsn = db.alt_conn_string
+        if dsn not in self.tables:
+            query = '''SELECT table_name, column_name, data_type
+                        FROM information_schema.columns
+                        WHERE table_schema = current_schema();'''
+            parts_query = '''SELECT parent.relname, child.relname
+                            FROM pg_class parent
+                            LEFT JOIN pg_inherits i ON i.inhparent = parent.oid
+                            LEFT JOIN pg_class child ON child.oid = i.inhrelid
+                            WHERE parent.relkind = 'p'
+                            AND parent.relnamespace = current_schema()::regnamespace;'''
+            with db.connection() as conn:
+                with conn.cursor() as cur:
+                    cur.execute(query)
+                    resp = cur.fetchall()
+                    cur.execute(parts_query)
+                    parts = cur.fetchall()
+
+            tables = {}
+            types = {}
+            for table, column, data_type in resp:
+                tables.setdefault(table, set()).add(column)
+                types.setdefault(table, {})[column] = data_type
+            self.tables[dsn] = tables
+            self.types[dsn] = types
+
+            partitions = {}
+            for parent, child in parts:
+                partitions.setdefault(parent, set())
+                if child is not None:
+                    partitions[parent].add(child)
+            self.partitions[dsn] = partitions
+
+        return self.tables[dsn]
+
+    #Returns the set of columns of the table or None if it does not exist
+    def columns(self, db, table_name):
+        with self.lock:
+            return self.load(db).get(table_name.lower())
+
+    #Returns the information_schema data_type of each column of the table
+    def column_types(self, db, table_name):
+        with self.lock:
+            self.load(db)
+            return dict(self.types[db.alt_conn_string].get(table_name.lower(), {}))
+
+    def add(self, db, table_name, columns):
+        with self.lock:
+            self.load(db).setdefault(table_name.lower(), set()).update(columns)
+
+    #Function to re-read a single table after DDL that may have been a no-op,
+    #the table could already exist with other column types
+    def reload(self, db, table_name):
+        query = '''SELECT column_name, data_type
+                    FROM information_schema.columns
+                    WHERE table_schema = current_schema() AND table_name = %s;'''
+        with db.connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(query, (table_name.lower(),))
+                resp = cur.fetchall()
+        with self.lock:
+            self.load(db)
+            self.tables[db.alt_conn_string][table_name.lower()] = {col for col, data_type in resp}
+            self.types[db.alt_conn_string][table_name.lower()] = dict(resp)
+
+    #Returns the set of partitions of the table or None if it is not partitioned
+    def table_partitions(self, db, table_name):
+        with self.lock:
+            self.load(db)
+            return self.partitions[db.alt_conn_string].get(table_name.lower())
+
+    def add_partitions(self, db, table_name, names):
+        with self.lock:
+            self.load(db)
+            self.partitions[db.alt_conn_string].setdefault(table_name.lower(), set()).update(names)
+
+    #Function to drop cached entries after tables are changed outside create_table
+    def forget(self, db, table_name=None):
+        with self.lock:
+            if table_name is None:
+                self.tables.pop(db.alt_conn_string, None)
+                self.types.pop(db.alt_conn_string, None)
+                self.partitions.pop(db.alt_conn_string, None)
+            elif db.alt_conn_string in self.tables:
+                self.tables[db.alt_conn_string].pop(table_name.lower(), None)
+                self.types[db.alt_conn_string].pop(table_name.lower(), None)
+                self.partitions[db.alt_conn_string].pop(table_name.lower(), None)
+
+schema = SchemaRegistry()
+#(dsn, table) pairs already reported as unpartitioned
+unmigrated = set()
+
+#Function to turn a posted date value into the date object a DATE column binds
+def to_date(value):
+    if value is None or isinstance(value, datetime.date):
+        return value
+    return datetime.date.fromisoformat(str(value)[:10])
+
+#Small cache for lookup query results. Entries are keyed with a version
+#value (e.g. the latest index_comps date) which is itself re-read at most
+#once every version_ttl seconds
+class LookupCache:
+    def __init__(self, version_ttl=60, max_entries=256):
+        self.version_ttl = version_ttl
+        self.max_entries = max_entries
+        self.versions = {}
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def version(self, name, probe):
+        with self.lock:
+            value, checked = self.versions.get(name, (None, None))
+        if checked is not None and time.monotonic() - checked < self.version_ttl:
+            return value
+
+        value = probe()
+        with self.lock:
+            self.versions[name] = (value, time.monotonic())
+        return value
+
+    def get(self, key, compute):
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                return self.entries[key]
+
+        value = compute()
+        with self.lock:
+            self.entries[key] = value
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return value
+
+    def clear(self):
+        with self.lock:
+            self.versions = {}
+            self.entries = OrderedDict()
+
+lookups = LookupCache()
+
+manager = ConnectionManager(min_size=secret.database['GOOG'].get('pool_min', 1),
+                            max_size=secret.database['GOOG'].get('pool_max', 10))
+atexit.register(manager.close)
+
 class Database:
 
+    #Tables with large payloads load through COPY instead of row upserts
+    bulk_copy = False
+
+    #Declarative partitioning of new tables: ('range', date column) for yearly
+    #partitions or ('hash', column, modulus)
+    partition = None
+
+    #Indexes created with the table: (method, [columns])
+    indexes = []
+
+    #SQL types of the columns that do not follow dtype_mapping
+    column_types = {}
+
     def __init__(self, table_name, constraints):
 
         self.dtype_mapping = {'int64': 'BIGINT',
@@ -74,41 +375,241 @@ class Database:
         self.constraints = constraints
 
     def engine(self):
-        return create_engine(self.conn_string)
+        return manager.engine(self.conn_string)
     
+    #Pooled connection, use as a context manager
     def connection(self):
-        conn = sql.connect(self.alt_conn_string)
-        return conn
+        return manager.connection(self.alt_conn_string)
+
+    #Function to read the result of a query straight into a dataframe
+    def read_frame(self, query, params=None):
+        with self.engine().connect() as conn:
+            frame = pd.read_sql_query(text(query), conn, params=params)
+        return frame
         
     def create_table_stmt(self):
         dtypes = self.dtypes
 
-        cols_string = ''.join([f'{col} {self.dtype_mapping[str(dtyp)]}, ' for col,dtyp in dtypes]).rstrip(', ')
+        cols_string = ''.join([f'{col} {self.sql_type(col, dtyp)}, ' for col,dtyp in dtypes]).rstrip(', ')
         const_string = ', '.join(const for const in self.constraints).rstrip(', ')
 
 
         stmt = f'''CREATE TABLE IF NOT EXISTS {self.table_name} 
-                    ({cols_string}, CONSTRAINT {self.table_name}_uniques UNIQUE ({const_string}) )'''
+                    ({cols_string}, CONSTRAINT {self.table_name}_uniques UNIQUE ({const_string}) )
+                    {self.partition_clause()}'''
         
         return stmt
 
-    def create_table(self):
-        stmt = self.create_table_stmt()
+    #Range partitions on a text column would compare by collation, the
+    #partition column of range partitioned tables is a DATE
+    def sql_type(self, col, dtyp):
+        if col in self.column_types:
+            return self.column_types[col]
+        if self.partition is not None and self.partition[0] == 'range' and col == self.partition[1]:
+            return 'DATE'
+        return self.dtype_mapping[str(dtyp)]
+
+    def partition_clause(self):
+        if self.partition is None:
+            return ''
+        elif self.partition[0] == 'range':
+            return f'PARTITION BY RANGE ({self.partition[1]})'
+        else:
+            return f'PARTITION BY HASH ({self.partition[1]})'
+
+    #Statements creating the fixed partitions of a new partitioned table
+    def base_partitions_stmts(self, table_name=None):
+        table_name = self.table_name if table_name is None else table_name
+        if self.partition is None:
+            return {}
+        elif self.partition[0] == 'range':
+            name = f'{table_name}_default'
+            return {name: f'''CREATE TABLE IF NOT EXISTS {name} PARTITION OF {table_name} DEFAULT;'''}
+        else:
+            modulus = self.partition[2]
+            return {f'{table_name}_p{i}': f'''CREATE TABLE IF NOT EXISTS {table_name}_p{i} PARTITION OF {table_name}
+                                              FOR VALUES WITH (MODULUS {modulus}, REMAINDER {i});'''
+                    for i in range(modulus)}
+
+    def year_partition_stmt(self, year:int, table_name=None):
+        table_name = self.table_name if table_name is None else table_name
+        return f'''CREATE TABLE IF NOT EXISTS {table_name}_y{year} PARTITION OF {table_name}
+                    FOR VALUES FROM ('{year}-01-01') TO ('{year + 1}-01-01');'''
+
+    def index_stmts(self, table_name=None):
+        table_name = self.table_name if table_name is None else table_name
+        stmts = []
+        for method, columns in self.indexes:
+            name = f'{table_name}_' + '_'.join(columns) + ('' if method == 'btree' else f'_{method}')
+            stmts.append(f'''CREATE INDEX IF NOT EXISTS {name}
+                            ON {table_name} USING {method} ({', '.join(columns)});''')
+        return stmts
+
+    #Function to create the configured indexes on an existing table
+    def create_indexes(self):
+        if len(self.indexes) == 0 or schema.columns(self, self.table_name) is None:
+            return True
+        try:
+            with self.connection() as conn:
+                with conn.cursor() as cur:
+                    for stmt in self.index_stmts():
+                        cur.execute(stmt)
+        except sql.Error as e:
+            print(f'Error creating indexes on {self.table_name}:', e)
+            return False
+        return True
+
+    #Values of the partition column in the data about to be posted
+    def partition_values(self):
+        return [row.get(self.partition[1]) for row in self.raw_data]
+
+    #Function to create the yearly partitions the current data falls in,
+    #so rows never land in the default partition
+    #Columns the table stores as DATE, asyncpg only binds date objects to them
+    #while tables created before the partitioning migration keep text dates
+    def date_columns(self):
+        types = schema.column_types(self, self.table_name)
+        return [col for col in self.columns if types.get(str(col).lower()) == 'date']
+
+    #Function to point at the migration when a table predates its partitioning,
+    #such tables keep working unpartitioned with text dates
+    def check_partitioned(self):
+        if self.partition is None or (self.alt_conn_string, self.table_name) in unmigrated:
+            return True
+        if schema.table_partitions(self, self.table_name) is None:
+            unmigrated.add((self.alt_conn_string, self.table_name))
+            print(f'{self.table_name} is not partitioned, run "python -m content.eod migrate" to migrate it')
+        return True
+
+    def create_partitions(self):
+        existing = schema.table_partitions(self, self.table_name)
+        if existing is None or self.partition is None or self.partition[0] != 'range':
+            return True
+
+        years = pd.to_datetime(pd.Series(self.partition_values()), errors='coerce').dt.year.dropna().unique()
+        missing = {f'{self.table_name}_y{int(x)}': int(x) for x in years}
+        missing = {name: year for name, year in missing.items() if name not in existing}
+        if len(missing) == 0:
+            return True
 
         with self.connection() as conn:
             with conn.cursor() as cur:
-                cur.execute(stmt)
-                conn.commit()
+                for name, year in missing.items():
+                    cur.execute(self.year_partition_stmt(year))
+
+        schema.add_partitions(self, self.table_name, missing)
+        return True
+
+    #Function to convert an existing plain table into the partitioned layout
+    #in place: the table is copied into a new partitioned table with the
+    #configured indexes inside one transaction. A text range partition
+    #column is converted to DATE first
+    def migrate_partitions(self, keep_old:bool=False):
+        if self.partition is None:
+            return False
+        if schema.columns(self, self.table_name) is None:
+            #Nothing stored yet, the table is created partitioned
+            return False
+        if schema.table_partitions(self, self.table_name) is not None:
+            return True
+
+        old = f'{self.table_name}_unpartitioned'
+        const_string = ', '.join(self.constraints)
+
+        with self.connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(f'ALTER TABLE {self.table_name} RENAME TO {old};')
+
+                if self.partition[0] == 'range':
+                    column = self.partition[1]
+                    cur.execute(f'ALTER TABLE {old} ALTER COLUMN {column} TYPE DATE USING {column}::date;')
+
+                #index names are unique per schema, the constraint index is renamed with them
+                cur.execute('''SELECT indexname FROM pg_indexes
+                                WHERE schemaname = current_schema() AND tablename = %s;''', (old,))
+                for (index,) in cur.fetchall():
+                    cur.execute(f'ALTER INDEX {index} RENAME TO {index}_old;')
+
+                cur.execute(f'''CREATE TABLE {self.table_name} (LIKE {old} INCLUDING DEFAULTS)
+                                {self.partition_clause()};''')
+                cur.execute(f'''ALTER TABLE {self.table_name}
+                                ADD CONSTRAINT {self.table_name}_uniques UNIQUE ({const_string});''')
+
+                names = list(self.base_partitions_stmts().keys())
+                for stmt in self.base_partitions_stmts().values():
+                    cur.execute(stmt)
+
+                if self.partition[0] == 'range':
+                    cur.execute(f'''SELECT DISTINCT EXTRACT(YEAR FROM {self.partition[1]})
+                                    FROM {old} WHERE {self.partition[1]} IS NOT NULL;''')
+                    for (year,) in cur.fetchall():
+                        cur.execute(self.year_partition_stmt(int(year)))
+                        names.append(f'{self.table_name}_y{int(year)}')
+
+                cur.execute(f'INSERT INTO {self.table_name} SELECT * FROM {old};')
+
+                for stmt in self.index_stmts():
+                    cur.execute(stmt)
+
+                if keep_old == False:
+                    cur.execute(f'DROP TABLE {old};')
+
+        schema.forget(self)
+        unmigrated.discard((self.alt_conn_string, self.table_name))
+        return True
+
+    def add_columns_stmt(self, missing:list):
+        cols_string = ', '.join([f'ADD COLUMN IF NOT EXISTS {col} {self.sql_type(col, dtyp)}' for col, dtyp in missing])
+        stmt = f'''ALTER TABLE {self.table_name} {cols_string}'''
+        return stmt
+
+    #Function to create the table, or add the columns a new payload brings,
+    #issuing DDL only when the schema registry does not know them yet
+    def create_table(self):
+        #dtypes is usually a one-shot iterator from frame.dtypes.items()
+        self.dtypes = list(self.dtypes)
+        columns = [str(col).lower() for col, dtyp in self.dtypes]
+        known = schema.columns(self, self.table_name)
+
+        stmts = []
+        partitions = {}
+        if known is None:
+            #another process may have created the table with fewer columns,
+            #IF NOT EXISTS makes the ALTER a no-op for the ones already there
+            partitions = self.base_partitions_stmts()
+            stmts = [self.create_table_stmt(), self.add_columns_stmt(self.dtypes)] + list(partitions.values()) + self.index_stmts()
+        else:
+            missing = [(col, dtyp) for col, dtyp in self.dtypes if str(col).lower() not in known]
+            if len(missing) > 0:
+                stmts = [self.add_columns_stmt(missing)]
+
+        if len(stmts) > 0:
+            with self.connection() as conn:
+                with conn.cursor() as cur:
+                    for stmt in stmts:
+                        cur.execute(stmt)
+                    conn.commit()
+
+            if known is None:
+                schema.reload(self, self.table_name)
+            else:
+                schema.add(self, self.table_name, columns)
+            if self.partition is not None and known is None:
+                schema.add_partitions(self, self.table_name, partitions)
+
+        self.check_partitioned()
+        self.create_partitions()
         
         return True
 
     def gather_values(self):
         data = self.raw_data
+        dates = set(self.date_columns())
         values = []
         for _ in data:
             temp_tup=[]
             for entry in _:
-                temp_tup.append(_[entry])
+                temp_tup.append(to_date(_[entry]) if entry in dates else _[entry])
             values.append(tuple(temp_tup))
 
         return values
@@ -166,22 +667,214 @@ class Database:
 
             await connection.executemany(insert_query, values)
 
-    async def main(self):
-        pool = await asyncpg.create_pool(user=self.user, password=self.password , database=self.database, host=self.host)
+    #Function to bulk load the values into a staging table with binary COPY
+    #and merge them into the table with a single INSERT ... SELECT
+    async def async_copy_sql(self, pool):
+        #COPY quotes identifiers, tables are created with unquoted (lower case) names
+        columns = [str(x).lower() for x in self.columns]
+        constraints = [x.lower() for x in self.constraints]
+        values = self.gather_values()
+
+        cols_string = ', '.join(columns)
+        const_string = ', '.join(constraints)
+        excludes = [x for x in columns if x not in constraints]
+        if len(excludes) > 0:
+            excludes_str = 'DO UPDATE SET ' + ', '.join([f'{exclude} = EXCLUDED.{exclude}' for exclude in excludes])
+        else:
+            excludes_str = 'DO NOTHING'
 
-        await self.async_upsert_sql(pool)
+        staging = f'{self.table_name}_staging'
 
-        await pool.close()
+        async with pool.acquire() as connection:
+            async with connection.transaction():
+                await connection.execute(f'''CREATE TEMP TABLE {staging}
+                                            (LIKE {self.table_name} INCLUDING DEFAULTS)
+                                            ON COMMIT DROP;''')
+
+                await connection.copy_records_to_table(staging, records=values, columns=columns)
+
+                #Later rows win when a batch repeats a key, as with row upserts
+                await connection.execute(f'''INSERT INTO {self.table_name} ({cols_string})
+                                            SELECT DISTINCT ON ({const_string}) {cols_string}
+                                            FROM {staging}
+                                            ORDER BY {const_string}, ctid DESC
+                                            ON CONFLICT ({const_string})
+                                            {excludes_str};''')
+
+    async def main(self, copy=None):
+        copy = self.bulk_copy if copy is None else copy
+        pool = await manager.async_pool(self.user, self.password, self.database, self.host, self.port)
+
+        if copy == True:
+            await self.async_copy_sql(pool)
+        else:
+            await self.async_upsert_sql(pool)
     
-    def upsert_async(self):
-        asyncio.run(self.main())
+    #Function to run a read query on the asyncpg pool. Statements run through
+    #the connection statement cache so they are prepared once per connection,
+    #lists are passed as array parameters ($1::varchar[])
+    async def async_fetch(self, query, *args, frame=False):
+        pool = await manager.async_pool(self.user, self.password, self.database, self.host, self.port)
+        async with pool.acquire() as connection:
+            if frame == False:
+                return [tuple(x) for x in await connection.fetch(query, *args)]
+
+            statement = await connection.prepare(query)
+            resp = await statement.fetch(*args)
+            columns = [x.name for x in statement.get_attributes()]
+            return pd.DataFrame([tuple(x) for x in resp], columns=columns)
+
+    def fetch(self, query, *args, frame=False):
+        return source.run(self.async_fetch(query, *args, frame=frame))
+
+    def upsert_async(self, copy=None):
+        source.run(self.main(copy=copy))
+        return True
+
+    #Views computed from the table, refreshed after the table is updated
+    def dependent_views(self):
+        return []
+
+    def refresh_views(self):
+        for view in self.dependent_views():
+            try:
+                view.refresh()
+            except sql.Error as e:
+                print(f'Error refreshing {view.view}:', e)
+        return True
+
+    #Function to split the symbols to update into batches of self.limit
+    def batches(self, symbols:list):
+        return [symbols[i:i + self.limit] for i in range(self.ct, len(symbols), self.limit)]
+
+    #Objects holding the data to post after a call to data(). A shallow copy
+    #keeps this batch intact while data() builds the next one
+    def writers(self):
+        return [copy.copy(self)]
+
+    #Function to fetch and parse batch N+1 while batch N is written.
+    #data() runs in a worker thread, writes run on the shared loop and at
+    #most depth parsed batches wait to be written
+    def pipeline(self, batches:list, depth:int=2, **kwargs):
+        return source.run(self.async_pipeline(batches, depth, **kwargs))
+
+    async def async_pipeline(self, batches:list, depth:int=2, **kwargs):
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue(maxsize=depth)
+
+        #The end marker is only queued while the consumer runs, once it is
+        #gone the producer is cancelled and a put on the full queue would block
+        async def produce():
+            try:
+                for i, batch in enumerate(batches):
+                    print(f'{self.table_name}: batch {i + 1} of {len(batches)}')
+                    await loop.run_in_executor(None, functools.partial(self.data, batch, **kwargs))
+                    await queue.put(self.writers())
+            except asyncio.CancelledError:
+                raise
+            except BaseException:
+                await queue.put(None)
+                raise
+            await queue.put(None)
+
+        async def consume():
+            while True:
+                writers = await queue.get()
+                if writers is None:
+                    return True
+                for writer in writers:
+                    await loop.run_in_executor(None, writer.create_table)
+                    await writer.main()
+
+        producer = asyncio.create_task(produce())
+        try:
+            await consume()
+        except BaseException:
+            producer.cancel()
+            await asyncio.gather(producer, return_exceptions=True)
+            raise
+        await producer
+
         return True
     
 
+#Table of persisted period changes of a value column, one row per key and
+#date with the input value and one column per change (yoy, qoq, mom).
+#Subclasses set the table name and the key column
+class ChangesTable(Database):
+
+    def __init__(self, table_name:str, key:str):
+        self.key = key
+        self.constraints = [key, 'date']
+
+        Database.__init__(self, table_name, self.constraints)
+
+    #Function to read the changes stored for the keys, dates as datetimes
+    def stored(self, keys:list):
+        query = f'''SELECT * FROM {self.table_name}
+                    WHERE {self.key} = ANY(:keys);'''
+        try:
+            frame = self.read_frame(query, {'keys': list(keys)})
+        except:
+            #If table does not exist, nothing has been computed yet
+            frame = pd.DataFrame(columns=[self.key, 'date', 'value'])
+
+        frame['date'] = pd.to_datetime(frame['date'])
+        return frame
+
+    #Dates are stored as text like the tables the values come from
+    def data(self, frame:pd.DataFrame):
+        frame = frame.assign(date=frame['date'].dt.strftime('%Y-%m-%d'))
+        self.raw_data = frame_records(frame)
+
+        self.data_ = frame
+        self.columns = frame.columns
+        self.dtypes = frame.dtypes.items()
+
+        return frame
+
+    def post(self, frame:pd.DataFrame):
+        if len(frame) == 0:
+            return True
+        self.data(frame)
+        self.create_table()
+        self.upsert_async()
+        return True
+
+
+#Query of the period changes of value_col for each key. Like the calendar
+#shift of Transformations.batch_changes, every observation is moved n months
+#forward (month ends clip, Jan 31 + 1 month = Feb 28) and compared with the
+#observation of the key on that date. When several observations land on the
+#same date the latest one wins
+def changes_query(table_name:str, key:str, value_col:str):
+    periods = {'yoy': 12, 'qoq': 3, 'mom': 1}
+
+    changes = ',\n'.join(f'''(obs.value - p_{name}.value) / NULLIF(p_{name}.value, 0) AS {name}''' for name in periods)
+    joins = '\n'.join(f'''LEFT JOIN (SELECT DISTINCT ON ({key}, target) {key}, target, value
+                                FROM (SELECT {key}, date, (date + INTERVAL '{months} months')::date AS target, value
+                                      FROM obs) shifted
+                                ORDER BY {key}, target, date DESC) p_{name}
+                        ON p_{name}.{key} = obs.{key} AND p_{name}.target = obs.date'''
+                       for name, months in periods.items())
+
+    #values are cast through text, FRED reports missing values as '.'
+    return f'''WITH obs AS (SELECT {key}, date::date AS date, NULLIF({value_col}::text, '.')::float AS value
+                             FROM {table_name}
+                             WHERE NULLIF({value_col}::text, '.') IS NOT NULL)
+                SELECT obs.{key}, obs.date, obs.value,
+                {changes}
+                FROM obs
+                {joins}'''
+
 class Views:
 
+    #Columns of the unique index a view needs to be refreshed concurrently
+    unique_index = []
+
     def __init__(self):
-        self.connect = Database('', []).connection
+        self.db = Database('', [])
+        self.connect = self.db.connection
 
     def create_mat_view(self):
         view_name = self.view
@@ -194,6 +887,17 @@ class Views:
             conn.commit()
 
         return True
+
+    def create_unique_index(self):
+        query = f'''CREATE UNIQUE INDEX IF NOT EXISTS {self.view}_uniques
+                    ON {self.view} ({', '.join(self.unique_index)});'''
+
+        with self.connect() as conn:
+            cur = conn.cursor()
+            cur.execute(query)
+            conn.commit()
+
+        return True
     
     def update_full_view(self):
         query = f'''REFRESH MATERIALIZED VIEW 
@@ -205,9 +909,72 @@ class Views:
             conn.commit()
 
         return True
+
+    #Readers of the view are not blocked while it is refreshed
+    def update_concurrent_view(self):
+        query = f'''REFRESH MATERIALIZED VIEW CONCURRENTLY
+                    {self.view};'''
+        
+        with self.connect() as conn:
+            cur  = conn.cursor()
+            cur.execute(query)
+            conn.commit()
+
+        return True
     
     
+    def exists(self):
+        with self.connect() as conn:
+            cur = conn.cursor()
+            cur.execute('''SELECT 1 FROM pg_matviews
+                            WHERE schemaname = current_schema() AND matviewname = %s;''', (self.view,))
+            return cur.fetchone() is not None
+
+    #Function to bring an existing view up to date after its tables are
+    #updated, views never created are left to update_sequence
+    def refresh(self):
+        if not self.exists():
+            return False
+        if len(self.unique_index) > 0:
+            self.update_concurrent_view()
+        else:
+            self.update_full_view()
+        return True
+
     def update_sequence(self):
         self.create_mat_view()
-        self.update_full_view()
+        if len(self.unique_index) > 0:
+            self.create_unique_index()
+            self.update_concurrent_view()
+        else:
+            self.update_full_view()
         return True
+
+
+#View of the period changes of a value column, read back like a ChangesTable
+class ChangesView(Views):
+
+    def __init__(self, view:str, table_name:str, key:str, value_col:str):
+        self.view = view
+        self.table_name = table_name
+        self.key = key
+        self.value_col = value_col
+        self.unique_index = [key, 'date']
+
+        Views.__init__(self)
+
+    def query(self):
+        return changes_query(self.table_name, self.key, self.value_col)
+
+    #Function to read the changes of the keys from from_date on
+    def stored(self, keys:list, from_date='1900-01-01'):
+        query = f'''SELECT * FROM {self.view}
+                    WHERE {self.key} = ANY(:keys) AND date >= CAST(:from_date AS date);'''
+        try:
+            frame = self.db.read_frame(query, {'keys': list(keys), 'from_date': str(from_date)})
+        except:
+            #If the view does not exist, nothing has been computed yet
+            frame = pd.DataFrame(columns=[self.key, 'date', 'value'])
+
+        frame['date'] = pd.to_datetime(frame['date'])
+        return frame
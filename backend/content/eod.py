@@ -1,47 +1,61 @@
 import pandas as pd
+import numpy as np
 from . import source
-from .admin import Database
+from .admin import Database, ChangesTable, ChangesView, frame_records, lookups
 import re
+import os
+import json
+import tempfile
+import functools
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 from datetime import date, datetime, timedelta
 import time
 
 exchanges = ['NYSE', 'NYSE ARCA', 'NASDAQ', 'NYSE MKT']
 priority_set = ['GSPC', 'SML', 'MID', 'DJC', 'DJI', 'DJT', 'DJU', 'SPSIRE']
 
-#Update set that includes all the tickers in the exchanges listed above
-def master_update_set(exch=exchanges):
+lookup_tables = ['exchange', 'index_comps']
+
+#Write counters of the tables read by the lookups (Tickers and index
+#compositions), they change whenever either table is written to
+def lookup_tables_version(db):
+    query = '''SELECT relname, n_tup_ins + n_tup_upd + n_tup_del
+                FROM pg_stat_user_tables
+                WHERE schemaname = current_schema() AND relname = ANY($1::name[]);'''
+    try:
+        return tuple(sorted(db.fetch(query, lookup_tables)))
+    except:
+        #If the statistics cannot be read, nothing is reused
+        return time.monotonic()
+
+#Function to run a lookup query through the cache, the results are reused
+#until the exchange or index_comps tables are written to
+def cached_lookup(query:str, *args, frame:bool=False):
     db = Database('_', [])
+    version = lookups.version('lookup_tables', lambda: lookup_tables_version(db))
+    key = (query, tuple(tuple(x) if isinstance(x, list) else x for x in args), frame, version)
 
-    exchanges_str = ','.join([f"'{x}'" for x in exch])
-    query = f'''SELECT Code FROM exchange
-                WHERE exchange IN ({exchanges_str})
+    return lookups.get(key, lambda: db.fetch(query, *args, frame=frame))
+
+#Update set that includes all the tickers in the exchanges listed above
+def master_update_set(exch=exchanges):
+    query = '''SELECT Code FROM exchange
+                WHERE exchange = ANY($1::varchar[])
                 and type='Common Stock';'''
-    
-    with db.connection() as conn:
-        cur = conn.cursor()
-        cur.execute(query)
-        resp = cur.fetchall()
-    
-    resp = [_[0] for _ in resp]
-    return resp
+
+    resp = cached_lookup(query, list(exch))
+    return [_[0] for _ in resp]
 
 #Update set that only takes tickers in the indexes listed above
 def priority_update_set(inds:list = priority_set):
-    db = Database('_', [])
-
-    index_str = ','.join([f"'{x}'" for x in inds])
-    query = f'''SELECT distinct code 
+    query = '''SELECT distinct code 
                 FROM index_comps
-                WHERE indcode IN ({index_str})
-                and date = (SELECT max(date) FROM index_comps WHERE indcode IN ({index_str}));'''
-    
-    with db.connection() as conn:
-        cur = conn.cursor()
-        cur.execute(query)
-        resp = cur.fetchall()
-    
-    resp = [_[0] for _ in resp]
-    return resp
+                WHERE indcode = ANY($1::varchar[])
+                and date = (SELECT max(date) FROM index_comps WHERE indcode = ANY($1::varchar[]));'''
+
+    resp = cached_lookup(query, list(inds))
+    return [_[0] for _ in resp]
 
 #Update set for indexes listed above
 def master_index_update_set():
@@ -63,13 +77,16 @@ def master_etf_update_set():
     return resp  
 
 
-rem_ints = lambda x: re.sub(r'\d+', '', x)
+digits = re.compile(r'\d+')
+leading_ints = re.compile(r'(\d+)(.*)', re.DOTALL)
+
+rem_ints = lambda x: digits.sub('', x)
 
 #Function to move any integers to the end of the string when creating
 #a sql table (Avoids conflict)
 def move_integers_to_end(input_string):
     # Use regular expressions to find the leading integers
-    match = re.match(r'(\d+)(.*)', input_string)
+    match = leading_ints.match(input_string)
     if match:
         numbers = match.group(1)
         rest_of_string = match.group(2)
@@ -79,11 +96,139 @@ def move_integers_to_end(input_string):
         result = input_string
     return result
 
+#Persistent mapping of field name to column name, shared by every batch
+#and loaded by each parser process from field_names_path
+field_names_path = os.path.join(os.path.dirname(__file__), 'field_names.json')
+field_names = {}
+
+def load_field_names(path:str=None):
+    path = field_names_path if path is None else path
+    try:
+        with open(path) as f:
+            field_names.update(json.load(f))
+    except (OSError, ValueError):
+        pass
+    return field_names
+
+#Each writer gets its own temporary file, os.replace swaps it in atomically
+def save_field_names(path:str=None):
+    path = field_names_path if path is None else path
+    with tempfile.NamedTemporaryFile('w', dir=os.path.dirname(path), suffix='.tmp', delete=False) as f:
+        json.dump(field_names, f, sort_keys=True)
+    try:
+        os.replace(f.name, path)
+    except OSError:
+        os.remove(f.name)
+        raise
+    return True
+
+#Function to look up the column name of a field, new names are learned
+def column_name(field:str):
+    name = field_names.get(field)
+    if name is None:
+        name = field_names[field] = move_integers_to_end(field)
+    return name
+
+#Function to rename a whole key tuple with one dictionary lookup
+@functools.lru_cache(maxsize=4096)
+def rename_keys(keys:tuple):
+    return tuple(column_name(x) for x in keys)
+
+load_field_names()
+
+#Generators of (set, row) pairs for the fundamentals responses
+def bulk_rows(raw_data:dict, sets:list):
+    for _ in raw_data:
+        code = raw_data[_]['General']['Code']
+        for subset in raw_data[_]:
+            if subset in sets:
+                row = dict(raw_data[_][subset])
+                row['Code'] = code
+                yield subset, row
+
+def financial_rows(raw_data:dict, sets:list):
+    for _ in raw_data:
+        if not isinstance(raw_data[_], dict):
+            continue
+        for subset in raw_data[_]:
+            if subset in sets:
+                quarterly = raw_data[_][subset]['quarterly']
+                for entry in quarterly:
+                    row = dict(quarterly[entry])
+                    row['Code'] = _
+                    yield subset, row
+
+#Function to normalize a shard of fundamentals responses. Rows are grouped
+#by their key set so column names are remapped once per distinct key set.
+#Returns {set: {column names: [row values]}} and the field names learned
+#by this shard. Runs in worker processes
+def normalize_shard(extract, raw_data:dict, sets:list):
+    known = set(field_names)
+    result = {x: {} for x in sets}
+    for subset, row in extract(raw_data, sets):
+        names = rename_keys(tuple(row))
+        result[subset].setdefault(names, []).append(tuple(row.values()))
+
+    learned = {x: field_names[x] for x in field_names if x not in known}
+    return result, learned
+
+parse_pool = None
+
+#Process pool shared by the fundamentals parsers, created on first use.
+#Workers are spawned, forking here would copy the locks held by the shared
+#event loop and pipeline threads
+def get_parse_pool(workers:int):
+    global parse_pool
+    if parse_pool is None:
+        parse_pool = ProcessPoolExecutor(max_workers=workers, initializer=load_field_names,
+                                         mp_context=multiprocessing.get_context('spawn'))
+    return parse_pool
+
+#Function to normalize fundamentals responses into one frame per set,
+#sharding the responses across a process pool when there are enough
+def normalize(extract, raw_data:dict, sets:list, workers:int=1, shard_min:int=50):
+    items = list(raw_data.items())
+    shards = min(workers, len(items) // shard_min)
+
+    if shards > 1:
+        parts = [dict(items[i::shards]) for i in range(shards)]
+        results = list(get_parse_pool(workers).map(normalize_shard, [extract] * shards, parts, [sets] * shards))
+    else:
+        results = [normalize_shard(extract, raw_data, sets)]
+
+    learned = {}
+    for result, names in results:
+        learned.update(names)
+    if len(learned) > 0:
+        field_names.update(learned)
+        save_field_names()
+    results = [result for result, names in results]
+
+    frames = {}
+    for subset in sets:
+        groups = {}
+        for result in results:
+            for names, values in result[subset].items():
+                groups.setdefault(names, []).extend(values)
+
+        columns = list(dict.fromkeys(name for names in groups for name in names))
+        parts = [pd.DataFrame(values, columns=list(names)) for names, values in groups.items()]
+        if len(parts) > 0:
+            frames[subset] = pd.concat(parts, ignore_index=True).reindex(columns=columns)
+        else:
+            frames[subset] = pd.DataFrame()
+
+    return frames
+
 #Class to organize and post to database intraday price data
 #for instruments in the EODData api
 #NOTE: DESIGN SO IT CAN BE USED FOR INDEXES AS WELL AS STOCKS/ETFS
 class Intraday(Database):
 
+    #Writes to the historical tables, same layout as Historical
+    partition = ('range', 'date')
+    indexes = [('btree', ['symbol', 'date']), ('brin', ['date'])]
+
     def __init__(self, bulk = 'stock'):
         self.source = source.EODData()
         self.endpoint = self.source.intraday
@@ -95,8 +240,6 @@ class Intraday(Database):
         self.bulk = bulk
         self.ct = 0
         self.limit = 15
-        self.sleep_time = 10
-        self.sleep_ct = 100
         self.errors = []
 
         Database.__init__(self, self.table_name, self.constraints)
@@ -143,25 +286,8 @@ class Intraday(Database):
                         'stock': priority_update_set, 
                         'etf': master_etf_update_set}
         symbols = update_sets[self.bulk]()
-        
-        steps = self.limit
 
-        ct=self.ct
-        sleep_ct = 0
-        while ct <= len(symbols):
-            
-            symbols_set = symbols[ct:min(ct+steps, len(symbols))]
-            print(symbols_set)
-            print(ct, ct+steps)
-            self.data(symbols_set)
-            self.create_table()
-            self.upsert_async()
-
-            ct+=steps
-            sleep_ct+=1
-            if sleep_ct == self.sleep_ct:
-                time.sleep(self.sleep_time)
-                sleep_ct = 0
+        self.pipeline(self.batches(symbols))
 
         return True
 
@@ -169,6 +295,13 @@ class Intraday(Database):
 #for instruments in the EODData api
 class Historical(Database):
 
+    bulk_copy = True
+
+    #Yearly partitions on date, the btree serves the per symbol watermark
+    #lookup and the BRIN range scans over dates
+    partition = ('range', 'date')
+    indexes = [('btree', ['symbol', 'date']), ('brin', ['date'])]
+
     def __init__(self, update_set:object = priority_update_set):
         self.source = source.EODData()
         self.endpoint = self.source.historical
@@ -178,94 +311,172 @@ class Historical(Database):
 
         self.ct = 0
         self.limit = 80
-        self.sleep_time = 10
-        self.sleep_ct = 3
+        self.price_cols = ['open', 'high', 'low', 'close', 'adjusted_close']
 
         Database.__init__(self, self.table_name, self.constraints)
     
-    #Function that verifies the last date of update in the
-    #specified set of symbols
-    def update_date(self, symbols:list):
+    #Symbol as stored in the table for a requested ticker
+    def symbol_name(self, symbol:str):
+        return symbol
+
+    #Function that returns the last stored date of each symbol, one
+    #index lookup per symbol instead of a scan of the whole table
+    def update_dates(self, symbols:list):
+        names = [self.symbol_name(x) for x in symbols]
+        query = f'''SELECT s.symbol, h.date
+                    FROM unnest(%s::varchar[]) AS s(symbol)
+                    CROSS JOIN LATERAL (SELECT date FROM {self.table_name}
+                                        WHERE symbol = s.symbol
+                                        ORDER BY date DESC
+                                        LIMIT 1) h;'''
         try:
-            query = f'''WITH dates AS (SELECT MAX(date) AS max_date
-                                        FROM {self.table_name}
-                                        GROUP BY symbol)
-                                        SELECT MIN(max_date)
-                                        FROM dates;'''
             with self.connection() as conn:
                 cur = conn.cursor()
-                cur.execute(query)
-                resp = cur.fetchone()
-
-            return resp[0]
+                cur.execute(query, (names,))
+                resp = dict(cur.fetchall())
         except:
-            #If table does not exist, return a very old date
-            return '1900-02-01'
+            #If table does not exist, nothing is stored yet
+            resp = {}
+
+        return {x: resp.get(self.symbol_name(x)) for x in symbols}
+
+    #Function to read the stored prices of the symbols from the from date on,
+    #only the requested columns are selected
+    def stored(self, symbols:list, from_date:str='1900-01-01', columns:list=None):
+        columns = self.price_cols + ['volume'] if columns is None else columns
+        names = {self.symbol_name(x): x for x in symbols}
+        query = f'''SELECT symbol, date, {', '.join(columns)}
+                    FROM {self.table_name}
+                    WHERE symbol = ANY(:symbols) AND date >= :from_date
+                    ORDER BY symbol, date;'''
+        try:
+            frame = self.read_frame(query, {'symbols': list(names), 'from_date': str(from_date)})
+        except:
+            #If table does not exist, nothing has been stored yet
+            frame = pd.DataFrame(columns=['symbol', 'date'] + columns)
 
-    def prep_raw(self, raw_data):
-        diclis = []
-        for _ in raw_data:
-            for entry in raw_data[_]:
-                temp = entry
-                temp['symbol'] = _
-                diclis.append(temp)
-        return diclis
+        frame['symbol'] = frame.symbol.map(names).astype('category')
+        return frame
+
+    #Function that returns the from date of each symbol that needs an update,
+    #symbols already updated today are left out
+    def from_dates(self, symbols:list, overlap:int=5):
+        today = date.today().strftime('%Y-%m-%d')
+        dates = {}
+        for symbol, last in self.update_dates(symbols).items():
+            if last is None:
+                dates[symbol] = '1900-02-01'
+            elif str(last) < today:
+                dates[symbol] = (datetime.strptime(str(last), '%Y-%m-%d') - timedelta(days=overlap)).strftime('%Y-%m-%d')
+        return dates
+
+    #Function that builds typed column arrays in a single pass over the
+    #raw responses, without intermediate frames or row dictionaries
+    def build_columns(self, raw_data):
+        responses = {k: v for k, v in raw_data.items() if isinstance(v, list) and len(v) > 0}
+        counts = np.array([len(v) for v in responses.values()], dtype='int64')
+        n = int(counts.sum())
+
+        dates = np.empty(n, dtype=object)
+        prices = {x: np.empty(n, dtype='float64') for x in self.price_cols}
+        volume = np.empty(n, dtype='float64')
+
+        pos = 0
+        for rows in responses.values():
+            end = pos + len(rows)
+            dates[pos:end] = [row['date'] for row in rows]
+            for col in self.price_cols:
+                prices[col][pos:end] = [row.get(col) for row in rows]
+            volume[pos:end] = [row.get('volume') for row in rows]
+            pos = end
+
+        if np.isfinite(volume).all():
+            volume = volume.astype('int64')
+
+        names = [self.symbol_name(x) for x in responses]
+        categories = {x: i for i, x in enumerate(dict.fromkeys(names))}
+        codes = np.repeat(np.array([categories[x] for x in names], dtype='int32'), counts)
+
+        columns = {'date': dates}
+        columns.update(prices)
+        columns['volume'] = volume
+        columns['symbol'] = pd.Categorical.from_codes(codes, categories=list(categories))
+
+        return columns
+
+    #Function to return column values as python objects with None for missing values
+    def column_values(self, values):
+        if isinstance(values, pd.Categorical):
+            return np.asarray(values, dtype=object).tolist()
+        if values.dtype.kind == 'f' and np.isnan(values).any():
+            return np.where(np.isnan(values), None, values).tolist()
+        return values.tolist()
+
+    def partition_values(self):
+        return self.buffers[self.partition[1]]
+
+    #Records for the upsert, built from the same column buffers as the frame.
+    #Dates are posted as date objects for the DATE partition column
+    def gather_values(self):
+        values = [self.column_values(self.buffers[x]) for x in self.columns]
+        #text dates for tables created before the DATE migration
+        if 'date' in self.date_columns():
+            dates = np.array(self.buffers['date'], dtype='datetime64[D]')
+            values[self.columns.index('date')] = dates.tolist()
+        return list(zip(*values))
             
     #Function that creates dataframe and cleans data for final
     #posting in the database
     def data(self, symbols:list, filter:str=False, **kwargs):
         raw_data = self.source.historical(symbols,adj=True, **kwargs)
-        self.raw_data = self.prep_raw(raw_data)
-
-        frame = pd.DataFrame()
+        self.buffers = self.build_columns(raw_data)
 
-        for _ in raw_data:
-            temp = pd.DataFrame(raw_data[_])
-            temp['symbol'] = _
-            frame = pd.concat([frame, temp])
+        dates = np.array(self.buffers['date'], dtype='datetime64[D]').astype('datetime64[ns]')
+        frame = pd.DataFrame({**self.buffers, 'date': dates}, copy=False)
 
         if filter == False:
             frame = frame
         else:
-            frame = frame.groupby(self.constraints).last()[filter]
+            frame = frame.groupby(self.constraints, observed=True).last()[filter]
             frame = frame.unstack('symbols').reset_index()
         
         self.data_ = frame
-        
-        cols = list(frame.columns)
-        cols.remove('symbol')
-        cols.append('symbol')
-
-        self.columns = frame[cols].columns
-        self.dtypes = frame.dtypes.items()
+        self.columns = list(self.buffers.keys())
+        #symbol is stored as a text column and date as the DATE partition column,
+        #gather_values posts whichever type the existing table has
+        self.dtypes = [(col, np.dtype('O') if col in ['date', 'symbol'] else self.buffers[col].dtype) for col in self.columns]
 
         return frame
     
     #Function to run updates on the set specified
     def update_sequence(self):
-        symbols = self.update_set()
-        from_date = self.update_date(symbols)
-        from_date = (datetime.strptime(from_date, '%Y-%m-%d') - timedelta(days=5)).strftime('%Y-%m-%d')
-        
-        steps = self.limit
-
-        ct=self.ct
-        sleep_ct = 0
-        while ct <= len(symbols):
-            symbols_set = symbols[ct:min(ct+steps, len(symbols))]
-            print(ct, ct+steps)
-            self.data(symbols_set, from_date=from_date)
-            self.create_table()
-            self.upsert_async()
-
-            ct+=steps
-            sleep_ct+=1
-            if sleep_ct == self.sleep_ct:
-                time.sleep(self.sleep_time)
-                sleep_ct = 0
+        #Tables that do not exist yet get their indexes when created
+        self.create_indexes()
+        from_dates = self.from_dates(self.update_set())
+        symbols = list(from_dates)
+
+        self.pipeline(self.batches(symbols), from_dates=from_dates)
+        self.refresh_views()
 
         return True
 
+    #The changes view is computed from the stock prices only
+    def dependent_views(self):
+        return [HistoricalChangesView()] if self.table_name == 'historical' else []
+
+#Period changes of the adjusted close, kept up to date by MarketData
+class HistoricalChanges(ChangesTable):
+
+    def __init__(self):
+        ChangesTable.__init__(self, 'hist_changes', 'symbol')
+
+#Period changes of the adjusted close computed in the database. Refresh
+#with update_sequence after the prices are updated
+class HistoricalChangesView(ChangesView):
+
+    def __init__(self):
+        ChangesView.__init__(self, 'hist_changes_view', 'historical', 'symbol', 'adjusted_close')
+
 #Class to organize and post historical price data for indexes
 class HistoricalIndex(Historical, Database):
 
@@ -280,14 +491,8 @@ class HistoricalIndex(Historical, Database):
 
         Database.__init__(self, self.table_name, self.constraints)
 
-    def prep_raw(self, raw_data):
-        diclis = []
-        for _ in raw_data:
-            for entry in raw_data[_]:
-                temp = entry
-                temp['symbol'] = _.rstrip('.INDX')
-                diclis.append(temp)
-        return diclis
+    def symbol_name(self, symbol:str):
+        return symbol.rstrip('.INDX')
 
 #Class to organize and post historical price data for indexes
 class HistoricalETF(Historical, Database):
@@ -303,15 +508,6 @@ class HistoricalETF(Historical, Database):
 
         Database.__init__(self, self.table_name, self.constraints)
 
-    def prep_raw(self, raw_data):
-        diclis = []
-        for _ in raw_data:
-            for entry in raw_data[_]:
-                temp = entry
-                temp['symbol'] = _
-                diclis.append(temp)
-        return diclis
-
 #Class to organize and post general data on the indexes specified
 #in the priority set
 class Indexes(Database):
@@ -511,18 +707,7 @@ class General(Database):
     def update_sequence(self):
         symbols = self.update_set()
 
-        steps = self.limit
-
-        ct=self.ct
-
-        while ct <= len(symbols):
-            symbols_set = symbols[ct:min(ct+steps, len(symbols))]
-            print(ct, ct+steps)
-            self.data(symbols_set)
-            self.create_table()
-            self.upsert_async()
-
-            ct+=steps
+        self.pipeline(self.batches(symbols))
 
         return True  
 
@@ -574,17 +759,8 @@ class EarningsHist(Database):
 
     def update_sequence(self):
         symbols = self.update_set()
-        steps = self.limit
-        ct = self.ct
-
-        while ct <= len(symbols):
-            symbols_set = symbols[ct:min(ct+steps, len(symbols))]
-            print(ct, ct+steps)
-            self.data(symbols_set)
-            self.create_table()
-            self.upsert_async()
 
-            ct+=steps
+        self.pipeline(self.batches(symbols))
 
         return True  
 
@@ -661,6 +837,7 @@ class BulkFund(Database):
         self.update_set = update_set
         self.limit = 450
         self.ct = 0
+        self.workers = os.cpu_count() or 1
         self.table_name = 'None'
         self.constraints = []
 
@@ -670,66 +847,23 @@ class BulkFund(Database):
         raw_data = self.endpoint(symbols=symbols, **kwargs)['bulk']
         self.raw_data = raw_data
 
-        dic = {}
-        for _ in self.sets.keys():
-            dic[_] = []
+        frames = normalize(bulk_rows, raw_data, list(self.sets), self.workers)
 
-        for _ in raw_data:
-            code  = raw_data[_]['General']['Code']
-            for subset in raw_data[_]:
-                if subset in self.sets.keys():
-                    temp = raw_data[_][subset]
-                    temp['Code'] = code
-                    dic[subset].append(temp)
-                else:
-                    continue
-        
-        for _ in dic:
-            frame = pd.DataFrame(dic[_])
-            frame.columns = [move_integers_to_end(x) for x in frame.columns]
-            setattr(self, _ , self.sets[_](frame))
+        for _ in self.sets:
+            setattr(self, _ , self.sets[_](frames[_]))
             att = getattr(self, _ )
-            att.raw_data = dic[_]
-
-        for _ in self.sets.keys():
-            att = getattr(self, _)
-            raw_data = att.raw_data
+            att.raw_data = frame_records(frames[_])
 
-            diclis = []
-            for entry in raw_data:
+        return frames
 
-                temp = {}
-                keys = [move_integers_to_end(x) for x in entry.keys()]
-                alt_entry = dict(zip(keys, entry.values()))
-
-                for col in att.columns:
-                    if col not in alt_entry.keys():
-                        temp[col] = None
-                    else:                   
-                        temp[col] = alt_entry[col]
-                    
-                diclis.append(temp)
-            att.raw_data = diclis
-
-        return dic
+    #One table object per set is posted for each batch, empty sets are skipped
+    def writers(self):
+        return [getattr(self, x) for x in self.sets if len(getattr(self, x).data_.columns) > 0]
 
     def update_sequence(self):
         symbols = self.update_set()
-        steps = self.limit
-
-        ct=self.ct
-        while ct <= len(symbols):
-            symbols_set = symbols[ct:min(ct+steps, len(symbols))]
-            print(ct, ct+steps)
-            self.data(symbols_set)
-            
-            for obj in self.sets:
-    
-                att = getattr(self, obj)
-                att.create_table()         
-                att.upsert_async()
 
-            ct+=steps
+        self.pipeline(self.batches(symbols))
 
         return True
 
@@ -785,6 +919,7 @@ class Financials(Database):
         self.update_set = update_set
         self.limit = 100
         self.ct = 0
+        self.workers = os.cpu_count() or 1
         self.table_name = 'None'
         self.constraints = []
 
@@ -794,65 +929,36 @@ class Financials(Database):
         raw_data = self.endpoint(symbols=symbols, **kwargs)
         self.raw_data = raw_data
 
-        dic = {}
-        for _ in self.sets.keys():
-            dic[_] = []
+        frames = normalize(financial_rows, raw_data, list(self.sets), self.workers)
 
-        for _ in raw_data:
-            for subset in raw_data[_]:
-                if subset in self.sets.keys():
-                    for entry in raw_data[_][subset]['quarterly']:
-                        temp = raw_data[_][subset]['quarterly'][entry]
-                        temp['Code'] = _
-                        dic[subset].append(temp)
-                else:
-                    continue
-        
-        for _ in dic:
-            frame = pd.DataFrame(dic[_])
-            frame.columns = [move_integers_to_end(x) for x in frame.columns]
-            setattr(self, _ , self.sets[_](frame))
+        for _ in self.sets:
+            setattr(self, _ , self.sets[_](frames[_]))
             att = getattr(self, _ )
-            att.raw_data = dic[_]
+            att.raw_data = frame_records(frames[_])
 
-        for _ in self.sets.keys():
-            att = getattr(self, _)
-            raw_data = att.raw_data
-
-            diclis = []
-            for entry in raw_data:
-
-                temp = {}
-                keys = [move_integers_to_end(x) for x in entry.keys()]
-                alt_entry = dict(zip(keys, entry.values()))
-
-                for col in att.columns:
-                    if col not in alt_entry.keys():
-                        temp[col] = None
-                    else:                   
-                        temp[col] = alt_entry[col]
-                    
-                diclis.append(temp)
-            att.raw_data = diclis
+        return frames
 
-        return dic
+    #One table object per set is posted for each batch, empty sets are skipped
+    def writers(self):
+        return [getattr(self, x) for x in self.sets if len(getattr(self, x).data_.columns) > 0]
 
     def update_sequence(self):
         symbols = self.update_set()
-        steps = self.limit
 
-        ct=self.ct
-        while ct <= len(symbols):
-            symbols_set = symbols[ct:min(ct+steps, len(symbols))]
-            print(ct, ct+steps)
-            self.data(symbols_set)
-            
-            for obj in self.sets:
-    
-                att = getattr(self, obj)
-                att.create_table()         
-                att.upsert_async()
+        self.pipeline(self.batches(symbols))
+
+        return True
+
+#Function to move the existing price tables to the partitioned layout
+def migrate_price_tables():
+    for table in [Historical, HistoricalIndex, HistoricalETF]:
+        obj = table()
+        print(f'{obj.table_name}: migrating to partitions')
+        obj.migrate_partitions()
 
-            ct+=steps
+    return True
 
-        return True
\ No newline at end of file
+if __name__ == '__main__':
+    import sys
+    if sys.argv[1:] == ['migrate']:
+        migrate_price_tables()
@@ -1,6 +1,6 @@
 import pandas as pd
 from . import source
-from .admin import Database
+from .admin import Database, ChangesTable, ChangesView, frame_records
 import re
 from datetime import date, datetime, timedelta
 import time
@@ -162,12 +162,16 @@ class Observations(Database):
 
         return dic_lis
 
-    def data(self):
-        raw_data = self.endpoint(self.series_ids)
+    #raw_data takes responses already requested, e.g. by series_responses
+    def data(self, series_ids:list=None, raw_data:dict=None):
+        series_ids = self.series_ids if series_ids is None else series_ids
+        raw_data = self.endpoint(series_ids) if raw_data is None else raw_data
         self.raw_data = self.prep_raw(raw_data)
 
-        frame = pd.DataFrame(self.raw_data)
+        frame = pd.DataFrame(self.raw_data, columns=['id'] + self.cols_)
         frame.value = pd.to_numeric(frame.value, errors='coerce')
+        #Keep the posted values numeric, FRED reports missing values as '.'
+        self.raw_data = frame_records(frame)
 
         self.data_ = frame
         self.columns = frame.columns
@@ -176,15 +180,47 @@ class Observations(Database):
 
         return frame
 
+    #Function to read the observations already stored for the series
+    def stored(self, series_ids:list=None):
+        series_ids = self.series_ids if series_ids is None else series_ids
+        query = f'''SELECT id, realtime_start, realtime_end, date, value
+                    FROM {self.table_name}
+                    WHERE id = ANY(:ids);'''
+        try:
+            frame = self.read_frame(query, {'ids': list(series_ids)})
+        except:
+            #If table does not exist, nothing has been stored yet
+            frame = pd.DataFrame(columns=['id'] + self.cols_)
+
+        frame.value = pd.to_numeric(frame.value, errors='coerce')
+        return frame
+
+    def dependent_views(self):
+        return [ObservationChangesView()]
+
     def update_sequence(self):
-        
-        self.data()
-        self.create_table()
-        self.upsert_async()
+
+        self.pipeline(self.batches(self.series_ids))
+        self.refresh_views()
 
         return True 
     
 
+#Period changes of the observations, kept up to date by EconData
+class ObservationChanges(ChangesTable):
+
+    def __init__(self):
+        ChangesTable.__init__(self, 'econ_hist_changes', 'id')
+
+
+#Period changes of the observations computed in the database. Refresh with
+#update_sequence after the observations are updated
+class ObservationChangesView(ChangesView):
+
+    def __init__(self):
+        ChangesView.__init__(self, 'econ_hist_changes_view', 'econ_hist', 'id', 'value')
+
+
 class SeriesMeta(Database):
 
     def __init__(self, series_ids:list):
@@ -229,11 +265,12 @@ class SeriesMeta(Database):
 
         return dic_lis
 
-    def data(self):
-        raw_data = self.endpoint(self.series_ids)
+    def data(self, series_ids:list=None, raw_data:dict=None):
+        series_ids = self.series_ids if series_ids is None else series_ids
+        raw_data = self.endpoint(series_ids) if raw_data is None else raw_data
         self.raw_data = self.prep_raw(raw_data)
 
-        frame = pd.DataFrame(self.raw_data)
+        frame = pd.DataFrame(self.raw_data, columns=self.cols_)
 
         self.data_ = frame
         self.columns = frame.columns
@@ -242,11 +279,23 @@ class SeriesMeta(Database):
 
         return frame
 
+    #Function to read the metadata already stored for the series
+    def stored(self, series_ids:list=None):
+        series_ids = self.series_ids if series_ids is None else series_ids
+        query = f'''SELECT {', '.join(self.cols_)}
+                    FROM {self.table_name}
+                    WHERE id = ANY(:ids);'''
+        try:
+            frame = self.read_frame(query, {'ids': list(series_ids)})
+        except:
+            #If table does not exist, nothing has been stored yet
+            frame = pd.DataFrame(columns=self.cols_)
+
+        return frame
+
     def update_sequence(self):
-        
-        self.data()
-        self.create_table()
-        self.upsert_async()
+
+        self.pipeline(self.batches(self.series_ids))
 
         return True 
     
@@ -279,8 +328,8 @@ class SeriesRelease(Database):
 
         return dic_lis
 
-    def data(self):
-        raw_data = self.endpoint(self.release_ids)
+    def data(self, raw_data:dict=None):
+        raw_data = self.endpoint(self.release_ids) if raw_data is None else raw_data
         self.raw_data = self.prep_raw(raw_data)
 
         frame = pd.DataFrame(self.raw_data)
@@ -298,4 +347,24 @@ class SeriesRelease(Database):
         self.create_table()
         self.upsert_async()
 
-        return True
\ No newline at end of file
+        return True
+
+
+#Endpoint groups requested together for a set of series
+def series_groups(api, series_ids:list, release:bool=True):
+    groups = {'observations': api.observ_params(series_ids),
+              'meta': api.series_meta_params(series_ids)}
+    if release == True:
+        groups['release'] = api.release_series_params(series_ids)
+    return groups
+
+#Function to request the observations, metadata and release of the series
+#in one concurrent fan out on the shared loop, can be awaited from any loop.
+#Raises source.RequestsFailed when a series could not be requested
+async def async_series_responses(series_ids:list, release:bool=True):
+    api = source.FREDData()
+    responses = await api.async_groups(series_groups(api, series_ids, release), strict=True)
+    return responses
+
+def series_responses(series_ids:list, release:bool=True):
+    return source.run(async_series_responses(series_ids, release))
@@ -3,14 +3,431 @@ import requests
 from . import secret
 import aiohttp
 import asyncio
-import nest_asyncio
+import threading
+import atexit
+import random
+import time
+import os
+import json
+import hashlib
+
+try:
+    import pyarrow as pa
+    from pyarrow import ipc
+except ImportError:
+    pa = None
+
+#Event loop running in a background thread. Sync callers submit coroutines
+#to it instead of starting a new loop per call, so long lived resources
+#(HTTP sessions, database pools) can be reused between calls
+class LoopThread:
+    def __init__(self):
+        self.loop = None
+        self.lock = threading.Lock()
+
+    def get_loop(self):
+        with self.lock:
+            if self.loop is None or self.loop.is_closed():
+                self.loop = asyncio.new_event_loop()
+                thread = threading.Thread(target=self.loop.run_forever, name='shared-loop', daemon=True)
+                thread.start()
+        return self.loop
+
+    def running_here(self):
+        try:
+            return asyncio.get_running_loop() is self.loop
+        except RuntimeError:
+            return False
+
+    #Function to run a coroutine on the shared loop and wait for the result
+    def run(self, coro):
+        loop = self.get_loop()
+        if self.running_here():
+            coro.close()
+            raise RuntimeError('Blocking call made from the shared loop, await the coroutine instead')
+        return asyncio.run_coroutine_threadsafe(coro, loop).result()
+
+    #Function to await a coroutine on the shared loop from any event loop
+    async def wrap(self, coro):
+        loop = self.get_loop()
+        if self.running_here():
+            return await coro
+        return await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(coro, loop))
+
+shared_loop = LoopThread()
+
+def run(coro):
+    return shared_loop.run(coro)
+
+
+#HTTP client with a keep-alive connection pool living on the shared loop
+class Client:
+    def __init__(self, limit=100, limit_per_host=20, keepalive=60, dns_ttl=300):
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.keepalive = keepalive
+        self.dns_ttl = dns_ttl
+        self.session = None
+
+    #Session is created lazily so it binds to the shared loop
+    def get_session(self):
+        if self.session is None or self.session.closed:
+            connector = aiohttp.TCPConnector(limit=self.limit,
+                                             limit_per_host=self.limit_per_host,
+                                             keepalive_timeout=self.keepalive,
+                                             ttl_dns_cache=self.dns_ttl)
+            self.session = aiohttp.ClientSession(connector=connector,
+                                                 timeout=aiohttp.ClientTimeout(total=120))
+        return self.session
+
+    #Function to request a url, raises on error statuses so callers can retry
+    async def fetch(self, url, payload):
+        async with self.get_session().get(url, params=payload) as response:
+            response.raise_for_status()
+            return await response.json()
 
-nest_asyncio.apply()
+    async def close_local(self):
+        if self.session is not None and not self.session.closed:
+            await self.session.close()
+
+    def close(self):
+        if shared_loop.loop is not None and not shared_loop.loop.is_closed():
+            shared_loop.run(self.close_local())
+        return True
+
+client = Client()
+atexit.register(client.close)
+
+
+#Token bucket, refills rate tokens per second up to capacity
+class TokenBucket:
+    def __init__(self, rate:float, capacity:float=None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = None
+
+    async def acquire(self):
+        if self.lock is None:
+            self.lock = asyncio.Lock()
+
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return True
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+#Request scheduler for one provider: rate limited with a token bucket, capped
+#by a semaphore and retried with jittered exponential backoff on 429/5xx
+#and connection errors. Failed keys are returned apart from the responses
+#instead of failing the whole batch
+class Scheduler:
+    def __init__(self, rate:float, burst:float=None, concurrency:int=10, retries:int=4, backoff:float=1, http=client):
+        self.bucket = TokenBucket(rate, burst)
+        self.concurrency = concurrency
+        self.retries = retries
+        self.backoff = backoff
+        self.http = http
+        self.semaphore = None
+
+    def retryable(self, error):
+        if isinstance(error, aiohttp.ClientResponseError):
+            return error.status == 429 or error.status >= 500
+        return isinstance(error, (aiohttp.ClientError, asyncio.TimeoutError))
+
+    def delay(self, attempt, error):
+        retry_after = None
+        if isinstance(error, aiohttp.ClientResponseError) and error.headers is not None:
+            retry_after = error.headers.get('Retry-After')
+        try:
+            return float(retry_after)
+        except (TypeError, ValueError):
+            return self.backoff * 2**attempt * random.uniform(0.5, 1.5)
+
+    async def fetch(self, url, payload):
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.concurrency)
+
+        attempt = 0
+        while True:
+            try:
+                async with self.semaphore:
+                    await self.bucket.acquire()
+                    return await self.http.fetch(url, payload)
+            except Exception as e:
+                if attempt >= self.retries or not self.retryable(e):
+                    raise
+                await asyncio.sleep(self.delay(attempt, e))
+                attempt += 1
+
+    #Returns a tuple of dictionaries (responses, failures)
+    async def gather_local(self, params:dict):
+        tasks = []
+        for key in params:
+            url, payload = params[key]
+            tasks.append(self.fetch(url, payload))
+
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+
+        responses = {}
+        failures = {}
+        for key, result in zip(params.keys(), results):
+            if isinstance(result, BaseException):
+                failures[key] = result
+            else:
+                responses[key] = result
+        return responses, failures
+
+    #Async API, can be awaited from any event loop
+    async def gather(self, params:dict):
+        return await shared_loop.wrap(self.gather_local(params))
+
+    #Sync API
+    def get_all(self, params:dict):
+        return shared_loop.run(self.gather_local(params))
+
+#Published limits: EOD 1000 calls per minute, FRED 120 calls per minute
+schedulers = {'EOD': Scheduler(rate=15, burst=30, concurrency=20),
+              'FRED': Scheduler(rate=2, burst=10, concurrency=8)}
+schedulers_lock = threading.Lock()
+
+#Scheduler shared by every request to the provider, providers without
+#published limits get a default one on first use
+def provider_scheduler(provider:str=None):
+    with schedulers_lock:
+        if provider not in schedulers:
+            schedulers[provider] = Scheduler(rate=10)
+        return schedulers[provider]
+
+#Raised when requests fail after their retries, failed holds the error
+#of each key and responses the requests that succeeded
+class RequestsFailed(Exception):
+    def __init__(self, failed:dict, responses:dict=None):
+        self.failed = failed
+        self.responses = responses if responses is not None else {}
+        Exception.__init__(self, 'Failed requests: ' + ', '.join(str(key) for key in failed))
+
+#On disk cache of API responses, keyed by url and parameters without the
+#API keys. Lists of records (and the record list of a response object) are
+#stored as Arrow IPC files read back through a memory map, other responses
+#and records Arrow cannot round trip exactly as JSON. Callers parse the
+#responses as records, so tables are converted back to records on read.
+#Entries expire after ttl seconds and the least recently used are removed
+#past max_bytes. A ttl of 0 disables the cache
+class ResponseCache:
+    secret_params = ['api_key', 'api_token']
+
+    def __init__(self, path, ttl=0, max_bytes=2 * 1024**3):
+        self.path = path
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        #bytes on disk, scanned on the first write and tracked from there
+        self.size = None
+        self.lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.ttl > 0
+
+    def key(self, url, payload):
+        params = {k: v for k, v in payload.items() if k not in self.secret_params}
+        raw = json.dumps([url, params], sort_keys=True, default=str)
+        return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+    def files(self, key):
+        return [os.path.join(self.path, key + ext) for ext in ['.arrow', '.json']]
+
+    #Records as an Arrow table, a response object keeps its other fields in
+    #the schema metadata. None when the response is not made of records
+    def to_table(self, response):
+        records, fields = response, None
+        if isinstance(response, dict):
+            lists = [k for k, v in response.items() if isinstance(v, list)]
+            if len(lists) != 1:
+                return None
+            records = response[lists[0]]
+            fields = {'list_field': lists[0], 'fields': {k: v for k, v in response.items() if k != lists[0]}}
+
+        if not isinstance(records, list) or len(records) == 0 or not all(isinstance(x, dict) for x in records):
+            return None
+        try:
+            table = pa.Table.from_pylist(records)
+        except (pa.ArrowInvalid, pa.ArrowTypeError, pa.ArrowNotImplementedError):
+            return None
+
+        #from_pylist takes the columns of the first record and coerces mixed
+        #types, records that do not come back unchanged are kept as JSON
+        if json.dumps(table.to_pylist()) != json.dumps(records):
+            return None
+
+        if fields is not None:
+            table = table.replace_schema_metadata({'response': json.dumps(fields)})
+        return table
+
+    def from_table(self, table):
+        records = table.to_pylist()
+        metadata = table.schema.metadata or {}
+        if b'response' not in metadata:
+            return records
+
+        fields = json.loads(metadata[b'response'])
+        response = dict(fields['fields'])
+        response[fields['list_field']] = records
+        return response
+
+    def get(self, url, payload):
+        if not self.enabled:
+            return None
+
+        for file in self.files(self.key(url, payload)):
+            try:
+                if time.time() - os.path.getmtime(file) > self.ttl:
+                    self.remove(file)
+                    continue
+                if file.endswith('.arrow'):
+                    with pa.memory_map(file) as source:
+                        response = self.from_table(ipc.open_file(source).read_all())
+                else:
+                    with open(file) as f:
+                        response = json.load(f)
+                #access time orders the eviction
+                os.utime(file, (time.time(), os.path.getmtime(file)))
+                return response
+            except (OSError, ValueError):
+                continue
+        return None
+
+    def file_size(self, file):
+        try:
+            return os.path.getsize(file)
+        except OSError:
+            return 0
+
+    def track(self, delta):
+        with self.lock:
+            if self.size is not None:
+                self.size += delta
+
+    def remove(self, file):
+        size = self.file_size(file)
+        os.remove(file)
+        self.track(-size)
+
+    #Function to write the response, returns the change in bytes on disk
+    def put(self, url, payload, response):
+        if not self.enabled:
+            return 0
+
+        os.makedirs(self.path, exist_ok=True)
+        arrow_file, json_file = self.files(self.key(url, payload))
+        table = self.to_table(response) if pa is not None else None
+        before = self.file_size(arrow_file) + self.file_size(json_file)
+
+        #written to a temporary file and moved in place so readers never see partial files
+        if table is not None:
+            temp = arrow_file + f'.{os.getpid()}.{threading.get_ident()}.tmp'
+            with pa.OSFile(temp, 'wb') as sink:
+                with ipc.new_file(sink, table.schema) as writer:
+                    writer.write_table(table)
+            os.replace(temp, arrow_file)
+        else:
+            temp = json_file + f'.{os.getpid()}.{threading.get_ident()}.tmp'
+            with open(temp, 'w') as f:
+                json.dump(response, f)
+            os.replace(temp, json_file)
+
+        #a response stored in the other format before is dropped
+        stale = json_file if table is not None else arrow_file
+        if os.path.exists(stale):
+            try:
+                os.remove(stale)
+            except OSError:
+                pass
+
+        return self.file_size(arrow_file) + self.file_size(json_file) - before
+
+    #Function to remove the least recently used entries past max_bytes
+    def evict(self):
+        if not self.enabled or not os.path.isdir(self.path):
+            return True
+
+        with self.lock:
+            entries = []
+            for entry in os.scandir(self.path):
+                if entry.is_file() and not entry.name.endswith('.tmp'):
+                    stat = entry.stat()
+                    entries.append((stat.st_atime, stat.st_size, entry.path))
+
+            total = sum(x[1] for x in entries)
+            for atime, size, file in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(file)
+                    total -= size
+                except OSError:
+                    pass
+            self.size = total
+
+        return True
+
+    #Function to split params into cached responses and params to request
+    def lookup(self, params:dict):
+        if not self.enabled:
+            return {}, dict(params)
+
+        cached = {}
+        missing = {}
+        for key, (url, payload) in params.items():
+            response = self.get(url, payload)
+            if response is None:
+                missing[key] = (url, payload)
+            else:
+                cached[key] = response
+        return cached, missing
+
+    #The directory is only scanned when the tracked size passes max_bytes
+    #(and once to start tracking)
+    def store(self, params:dict, responses:dict):
+        if not self.enabled or len(responses) == 0:
+            return True
+        delta = 0
+        for key, response in responses.items():
+            url, payload = params[key]
+            delta += self.put(url, payload, response)
+
+        with self.lock:
+            if self.size is not None:
+                self.size += delta
+            over = self.size is None or self.size > self.max_bytes
+        if over:
+            self.evict()
+        return True
+
+    #Responses in the order of the params requested
+    def merge(self, params:dict, cached:dict, responses:dict):
+        if len(cached) == 0:
+            return responses
+        return {key: cached[key] if key in cached else responses[key]
+                for key in params if key in cached or key in responses}
+
+#Set RESPONSE_CACHE_TTL (seconds) for backfills and development runs
+response_cache = ResponseCache(os.path.join(os.path.dirname(__file__), 'response_cache'),
+                               ttl=float(os.environ.get('RESPONSE_CACHE_TTL', 0)),
+                               max_bytes=int(os.environ.get('RESPONSE_CACHE_BYTES', 2 * 1024**3)))
 
 #Class to hold functions applicable to all APIs
 class BaseRequests:
-    def __init__(self):
-        pass
+    def __init__(self, provider:str=None):
+        self.scheduler = provider_scheduler(provider)
+        self.cache = response_cache
+        self.failed = {}
 
     #Function to build dictionary with all attributes of the payload
     def build_params(self, main_payload, adj=False,**kwargs):
@@ -36,29 +453,54 @@ class BaseRequests:
                 dic[symbol] = session.get(url = url, params=payload).json()
             return dic 
     
-    #Function to assemble api requests asynchronously
-    async def async_fetch_data(self, session, url, payload):
-        async with session.get(url, params=payload) as response:
-            return await response.json()
-        
     #Function to make bulk api requests asynchronously
+    #through the shared connection pool, can be awaited from any loop
     async def async_setup(self, params:dict):
-        async with aiohttp.ClientSession() as session:
-            tasks=[]
-            for key in params:
-                url, payload = params[key]
-                tasks.append(self.async_fetch_data(session, url, payload))
-            
-            responses = await asyncio.gather(*tasks)
-            return dict(zip(params.keys(), responses))
-        
-
-    def select_request(self, params, asyn=True):
+        cached, missing = await asyncio.to_thread(self.cache.lookup, params)
+        responses, self.failed = await self.scheduler.gather(missing)
+        self.report_failed()
+        await asyncio.to_thread(self.cache.store, missing, responses)
+        return self.cache.merge(params, cached, responses)
+
+    #Failed requests are left out of the responses and kept in self.failed
+    #for the caller, batch updates carry on with the keys that succeeded
+    def report_failed(self):
+        if len(self.failed) > 0:
+            print('Failed requests:', {key: repr(error) for key, error in self.failed.items()})
+        return True
+
+    #Function to request several endpoint groups in one fan out, every
+    #request goes through the scheduler at once. Returns {group: responses}.
+    #strict=True raises RequestsFailed if any request failed
+    async def async_groups(self, groups:dict, strict:bool=False):
+        params = {(group, key): value for group, dic in groups.items() for key, value in dic.items()}
+        responses = await self.async_setup(params)
+        if strict == True and len(self.failed) > 0:
+            raise RequestsFailed(self.failed, responses)
+
+        grouped = {group: {} for group in groups}
+        for (group, key), response in responses.items():
+            grouped[group][key] = response
+        return grouped
+
+    def select_groups(self, groups:dict, strict:bool=False):
+        return run(self.async_groups(groups, strict))
+
+    #Responses found in the response cache are not requested again,
+    #cache=False always requests them (e.g. real-time quotes)
+    def select_request(self, params, asyn=True, cache=True):
+        if cache == False:
+            cached, missing = {}, dict(params)
+        else:
+            cached, missing = self.cache.lookup(params)
         if asyn == True:
-            responses = asyncio.run(self.async_setup(params))
+            responses, self.failed = self.scheduler.get_all(missing)
+            self.report_failed()
         else:
-            responses = self.sync_request(params)
-        return responses                 
+            responses = self.sync_request(missing)
+        if cache == True:
+            self.cache.store(missing, responses)
+        return self.cache.merge(params, cached, responses)                 
     
 #End of day Data API wrapper
 class EODData(BaseRequests):
@@ -71,11 +513,12 @@ class EODData(BaseRequests):
                     'fmt': 'json'
                             }
     
-        BaseRequests.__init__(self)
+        BaseRequests.__init__(self, 'EOD')
 
     #Pair of functions to request data from the EOD endpoint
     #Function that builds dictionary of parameters for the api requests to the EOD endpoint
-    def historical_params(self, symbols:list, **kwargs):
+    #from_dates optionally sets a different start date per symbol
+    def historical_params(self, symbols:list, from_dates:dict={}, **kwargs):
 
         main_url = self.main_url
         endpoint = '/eod'
@@ -83,6 +526,8 @@ class EODData(BaseRequests):
         dic = {}
         for symbol in symbols:
             payload = self.build_params(self.main_params, **kwargs)
+            if symbol in from_dates:
+                payload['from'] = from_dates[symbol]
             url = main_url + endpoint + '/' + symbol
             dic[symbol] = (url, payload)
 
@@ -106,10 +551,11 @@ class EODData(BaseRequests):
         dic = {'intraday': (url, payload)}
         return dic
     
+    #Quotes are never served from the response cache
     def intraday(self, symbols:list, asyn=True, **kwargs):
         params = self.intraday_params(symbols, **kwargs)
-        responses = self.select_request(params, asyn=asyn)
-        return responses['intraday']
+        responses = self.select_request(params, asyn=asyn, cache=False)
+        return responses.get('intraday', [])
 
     #Function to retrieve tickers from a specified exchange
     def tickers_params(self, exchange:str='US', **kwargs):
@@ -248,15 +694,16 @@ class EODData(BaseRequests):
 #Fred Data API wrapper
 class FREDData(BaseRequests):
 
+    main_url = 'https://api.stlouisfed.org/fred'
+
     def __init__(self):
         self.api_key = secret.key_chain['FRED']
-        self.main_url = 'https://api.stlouisfed.org/fred'
         self.main_params = {
                     'api_key': self.api_key, 
                     'file_type': 'json'
                             }
     
-        BaseRequests.__init__(self)
+        BaseRequests.__init__(self, 'FRED')
 
     #Pair of functions to request data from the FRED endpoint
     #Function that builds dictionary of parameters for the api requests to the EOD endpoint
@@ -3,13 +3,713 @@ from content import fred
 from content import eod
 import pandas as pd
 import numpy as np
-from content.admin import Database as db
+from datetime import date, timedelta
+from collections import OrderedDict
+import threading
+import re
+import asyncio
+import json
+import time
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+#Stored series older than this window are refreshed from the API
+fresh_window = timedelta(days=1)
+
+#Raised for invalid request parameters, the endpoints answer 400
+class BadRequest(ValueError):
+    pass
+
+#Computation of a cache key in progress. Threads wait on the event and
+#coroutines on a future of their own loop, so waiting ties up no thread
+class Flight:
+    def __init__(self):
+        self.event = threading.Event()
+        self.futures = []
+        self.lock = threading.Lock()
+
+    def set(self):
+        with self.lock:
+            self.event.set()
+            futures, self.futures = self.futures, []
+        for loop, future in futures:
+            try:
+                loop.call_soon_threadsafe(self.resolve, future)
+            except RuntimeError:
+                #the waiting loop is closed
+                pass
+
+    @staticmethod
+    def resolve(future):
+        if not future.done():
+            future.set_result(True)
+
+    def wait(self):
+        return self.event.wait()
+
+    async def async_wait(self):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        with self.lock:
+            if self.event.is_set():
+                return True
+            self.futures.append((loop, future))
+        return await future
+
+
+#Bounded in-process cache with LRU eviction by size, per entry TTL
+#and single-flight computation of missing keys
+class PayloadCache:
+    def __init__(self, max_bytes=256 * 1024**2, ttl=15 * 60):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.pending = {}
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    #Functions below ending in _locked expect the caller to hold the lock
+    def drop_locked(self, key):
+        expires, size, value = self.entries.pop(key)
+        self.size -= size
+
+    def get_locked(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+
+        expires, size, value = entry
+        if expires < time.monotonic():
+            self.drop_locked(key)
+            return None
+
+        self.entries.move_to_end(key)
+        return value
+
+    def get(self, key):
+        with self.lock:
+            return self.get_locked(key)
+
+    def put(self, key, value, size):
+        with self.lock:
+            if key in self.entries:
+                self.drop_locked(key)
+            if size > self.max_bytes:
+                return False
+
+            self.entries[key] = (time.monotonic() + self.ttl, size, value)
+            self.size += size
+            while self.size > self.max_bytes:
+                self.drop_locked(next(iter(self.entries)))
+
+        return True
+
+    #Function to split the keys that are not in results into cached values,
+    #keys the caller has to compute and flights of keys computed elsewhere
+    def claim(self, keys:list, results:dict):
+        owned = []
+        waits = []
+        with self.lock:
+            for key in keys:
+                if key in results:
+                    continue
+                value = self.get_locked(key)
+                if value is not None:
+                    self.hits += 1
+                    results[key] = value
+                elif key in self.pending:
+                    waits.append(self.pending[key])
+                else:
+                    self.misses += 1
+                    self.pending[key] = Flight()
+                    owned.append(key)
+
+        return owned, waits
+
+    def store(self, owned:list, computed:dict, results:dict):
+        for key in owned:
+            value, size = computed[key]
+            self.put(key, value, size)
+            results[key] = value
+
+    def release(self, owned:list):
+        with self.lock:
+            for key in owned:
+                self.pending.pop(key).set()
+
+    #Function to return the values of all keys, calling compute once for
+    #the keys that are missing. compute receives a list of keys and returns
+    #a dictionary of key: (value, size). Keys already being computed by
+    #another thread are waited on instead of computed again
+    def get_many(self, keys:list, compute):
+        results = {}
+        while len(results) < len(keys):
+            owned, waits = self.claim(keys, results)
+
+            if len(owned) > 0:
+                try:
+                    self.store(owned, compute(owned), results)
+                finally:
+                    self.release(owned)
+
+            #If the other thread failed the key is computed on the next pass
+            for flight in waits:
+                flight.wait()
+
+        return results
+
+    #Async version of get_many for a coroutine compute, waits do not block the loop
+    async def async_get_many(self, keys:list, compute):
+        results = {}
+        while len(results) < len(keys):
+            owned, waits = self.claim(keys, results)
+
+            if len(owned) > 0:
+                try:
+                    self.store(owned, await compute(owned), results)
+                finally:
+                    self.release(owned)
+
+            for flight in waits:
+                await flight.async_wait()
+
+        return results
+
+    def stats(self):
+        with self.lock:
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'entries': len(self.entries),
+                    'bytes': self.size,
+                    'max_bytes': self.max_bytes}
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+
+#Serializers for series frames. Columns are converted as whole arrays:
+#dates are formatted in one strftime call and non finite values become null
+def date_strings(values:pd.Series):
+    return pd.to_datetime(values).dt.strftime('%Y-%m-%dT%H:%M:%S')
+
+#Function to convert the columns of a frame into JSON-safe lists
+def column_lists(frame:pd.DataFrame):
+    data = {}
+    for col in frame.columns:
+        values = frame[col]
+        if col == 'date' or pd.api.types.is_datetime64_any_dtype(values):
+            out = date_strings(values).astype(object)
+            data[col] = out.where(out.notnull(), None).tolist()
+        elif pd.api.types.is_numeric_dtype(values):
+            arr = values.to_numpy(dtype='float64')
+            data[col] = np.where(np.isfinite(arr), arr, None).tolist()
+        else:
+            data[col] = values.astype(object).where(values.notnull(), None).tolist()
+    return data
+
+#Function to encode a column as a compact JSON array
+def json_array(values:pd.Series):
+    if values.name == 'date' or pd.api.types.is_datetime64_any_dtype(values):
+        strs = date_strings(values)
+        out = np.where(strs.isna(), 'null', '"' + strs.fillna('') + '"')
+    elif pd.api.types.is_numeric_dtype(values):
+        arr = values.to_numpy(dtype='float64')
+        out = np.where(np.isfinite(arr), arr.astype(str), 'null')
+    else:
+        return json.dumps(values.astype(object).where(values.notnull(), None).tolist(), separators=(',', ':'))
+    return '[' + ','.join(out) + ']'
+
+#Function to encode the columns of a frame as a JSON object of arrays
+def encode_columns(frame:pd.DataFrame, encoding='compact'):
+    if encoding == 'orjson' and orjson is not None:
+        data = {}
+        for col in frame.columns:
+            values = frame[col]
+            if col == 'date' or pd.api.types.is_datetime64_any_dtype(values):
+                out = date_strings(values).astype(object)
+                data[col] = out.where(out.notnull(), None).tolist()
+            elif pd.api.types.is_numeric_dtype(values):
+                #orjson writes NaN and inf as null
+                data[col] = values.to_numpy(dtype='float64')
+            else:
+                data[col] = values.astype(object).where(values.notnull(), None).tolist()
+        return orjson.dumps(data, option=orjson.OPT_SERIALIZE_NUMPY)
+
+    data = ','.join(f'{json.dumps(col)}:{json_array(frame[col])}' for col in frame.columns)
+    return f'{{{data}}}'.encode('utf-8')
+
+#Function to encode one series entry of the api payload. meta is the
+#already encoded JSON of the metadata records
+def encode_series(series_id:str, meta:str, frame:pd.DataFrame, encoding='compact'):
+    return json.dumps(series_id).encode('utf-8') + b':{"meta":' + meta.encode('utf-8') + b',"data":' + encode_columns(frame, encoding) + b'}'
+
+#Generator yielding the api payload one series at a time
+#frames is a dictionary of series_id: (meta, frame)
+def stream_series(frames:dict, encoding='compact'):
+    yield b'{'
+    for i, (series_id, (meta, frame)) in enumerate(frames.items()):
+        if i > 0:
+            yield b','
+        yield encode_series(series_id, meta, frame, encoding)
+    yield b'}'
+
+#Function to align the frames of the series on a shared date axis, the
+#outer join on date of the pivot in EconData.get_data
+def aligned_frame(frames:dict):
+    parts = [frame.set_index('date') for meta, frame in frames.values()]
+    if len(parts) == 0:
+        return pd.DataFrame({'date': pd.Series([], dtype='datetime64[ns]')})
+
+    aligned = pd.concat(parts, axis=1).sort_index()
+    aligned.index.name = 'date'
+
+    return aligned.reset_index()
+
+#Function to encode the aligned payload: metadata of each series and one
+#object of columns sharing the date axis
+def encode_aligned(frames:dict, encoding='compact'):
+    meta = ','.join(f'{json.dumps(series_id)}:{meta}' for series_id, (meta, frame) in frames.items())
+    data = encode_columns(aligned_frame(frames), encoding)
+    return b'{"meta":{' + meta.encode('utf-8') + b'},"data":' + data + b'}'
+
+
+#Downsamplers, both return the sorted positions of the points kept and
+#always keep the first and last point
+
+#Largest-Triangle-Three-Buckets: one point per bucket, the one forming the
+#largest triangle with the previous pick and the mean of the next bucket.
+#The picks depend on each other so buckets are walked in order, each one
+#evaluated as a whole array
+def lttb_indices(x:np.ndarray, y:np.ndarray, max_points:int):
+    n = len(y)
+    if n <= max_points or max_points < 3:
+        return np.arange(n)
+
+    edges = np.linspace(1, n - 1, max_points - 1).astype('int64')
+    #Means of every bucket, the next bucket of the last one is the last point
+    sums = np.add.reduceat(np.column_stack([x[1:n - 1], y[1:n - 1]]), edges[:-1] - 1)
+    means = sums / np.diff(edges)[:, None]
+    means = np.vstack([means[1:], [[x[n - 1], y[n - 1]]]])
+
+    selected = np.empty(max_points, dtype='int64')
+    selected[0] = 0
+    selected[-1] = n - 1
+    a = 0
+    for i in range(max_points - 2):
+        lo, hi = edges[i], edges[i + 1]
+        area = np.abs((x[a] - means[i, 0]) * (y[lo:hi] - y[a]) - (x[a] - x[lo:hi]) * (means[i, 1] - y[a]))
+        a = lo + int(np.argmax(area))
+        selected[i + 1] = a
+
+    return selected
+
+#Min/max per bucket: the lowest and highest point of each bucket, computed
+#for all buckets at once
+def minmax_indices(x:np.ndarray, y:np.ndarray, max_points:int):
+    n = len(y)
+    if n <= max_points or max_points < 4:
+        return np.arange(n)
+
+    buckets = (max_points - 2) // 2
+    interior = y[1:n - 1]
+    bucket = (np.arange(n - 2) * buckets) // (n - 2)
+    starts = np.flatnonzero(np.diff(bucket, prepend=-1))
+    counts = np.diff(np.append(starts, n - 2))
+
+    picks = [np.array([0, n - 1])]
+    for values, reduce in [(np.where(np.isnan(interior), np.inf, interior), np.minimum),
+                           (np.where(np.isnan(interior), -np.inf, interior), np.maximum)]:
+        extreme = np.repeat(reduce.reduceat(values, starts), counts)
+        hits = np.flatnonzero(values == extreme)
+        #first hit of each bucket
+        first = hits[np.flatnonzero(np.diff(bucket[hits], prepend=-1))]
+        picks.append(first + 1)
+
+    return np.unique(np.concatenate(picks))
+
+downsamplers = {'lttb': lttb_indices, 'minmax': minmax_indices}
+#Fewest points each downsampler can reduce a series to, first and last
+#included. Fewer would return the whole series
+downsample_min = {'lttb': 3, 'minmax': 4}
+
+#Function to read the transformations of a request, e.g. ["YoY", "RollMean12"],
+#unknown transformations raise BadRequest
+def request_trans(data:dict):
+    trans = data.get("trans") or ('YoY', 'QoQ', 'MoM')
+    if not isinstance(trans, (list, tuple)):
+        raise BadRequest('trans must be a list of transformations')
+    for name in trans:
+        if isinstance(name, str) and name.startswith('RollCorr') and rolling_parts(name) is None:
+            raise BadRequest(f'{name} needs a window and a base series, e.g. RollCorr12:SP500')
+        if not isinstance(name, str) or (name not in period_trans and rolling_parts(name) is None):
+            raise BadRequest(f'Unknown transformation {name}')
+    return tuple(dict.fromkeys(trans))
+
+#Function to read the window and downsampling parameters of a request,
+#invalid values raise BadRequest
+def window_params(data:dict):
+    method = data.get("downsample", "lttb")
+    if method not in downsamplers:
+        raise BadRequest(f'downsample must be one of {", ".join(downsamplers)}')
+
+    max_points = data.get("max_points")
+    if max_points is not None:
+        if isinstance(max_points, bool) or not isinstance(max_points, (int, str)) or not str(max_points).isdigit():
+            raise BadRequest('max_points must be a positive integer')
+        max_points = int(max_points)
+        if max_points < downsample_min[method]:
+            raise BadRequest(f'max_points must be at least {downsample_min[method]} for {method}')
+
+    #series dates are naive, zoned dates are compared in UTC
+    dates = {}
+    for name in ['start', 'end']:
+        dates[name] = None
+        if data.get(name):
+            try:
+                value = pd.Timestamp(data[name])
+            except (TypeError, ValueError):
+                raise BadRequest(f'{name} must be a date')
+            if value is pd.NaT:
+                raise BadRequest(f'{name} must be a date')
+            dates[name] = value.tz_convert(None) if value.tzinfo is not None else value
+
+    return {'start': dates['start'],
+            'end': dates['end'],
+            'max_points': max_points,
+            'method': method}
+
+#Function to cut a series frame to the [start, end] window and reduce it to
+#at most max_points rows picked on value_col. Returns a new frame so the
+#cached full resolution frame is left intact
+def window_frame(frame:pd.DataFrame, value_col:str, start=None, end=None, max_points:int=None, method='lttb'):
+    if start or end:
+        dates = frame['date']
+        mask = np.ones(len(frame), dtype=bool)
+        if start:
+            mask &= (dates >= pd.Timestamp(start)).to_numpy()
+        if end:
+            mask &= (dates <= pd.Timestamp(end)).to_numpy()
+        frame = frame[mask]
+
+    if max_points is not None and len(frame) > max_points and value_col in frame.columns:
+        x = frame['date'].to_numpy(dtype='datetime64[ns]').astype('int64').astype('float64')
+        y = frame[value_col].to_numpy(dtype='float64')
+        frame = frame.iloc[downsamplers[method](x, y, max_points)]
+
+    return frame
+
+#Function to apply window_frame to every series of an econ_series result
+def window_frames(frames:dict, start=None, end=None, max_points:int=None, method='lttb'):
+    if not (start or end or max_points):
+        return frames
+    return {sid: (meta, window_frame(frame, sid, start, end, max_points, method)) for sid, (meta, frame) in frames.items()}
+
+
+#Rolling window helpers over 2D arrays of one row per column. Windows count
+#observations and not rows of a frame aligned with other frequencies, so
+#columns with gaps inside their history are compacted to their valid
+#observations first. Window sums are differences of cumulative sums, O(n)
+#whatever the window length
+
+#Function returning the columns whose valid values have gaps between them
+def gapped_columns(valid:np.ndarray, count:np.ndarray=None):
+    if valid.shape[1] == 0:
+        return np.zeros(valid.shape[0], dtype=bool)
+    count = valid.sum(axis=1) if count is None else count
+    first = valid.argmax(axis=1)
+    last = valid.shape[1] - valid[:, ::-1].argmax(axis=1)
+    return (count > 0) & (last - first != count)
+
+#Function to move the valid values of each row to the front, keeping their order
+def compact_rows(values:np.ndarray, valid:np.ndarray):
+    order = np.argsort(~valid, axis=1, kind='stable')
+    return np.take_along_axis(values, order, axis=1), np.take_along_axis(valid, order, axis=1), order
+
+#Inverse of compact_rows
+def expand_rows(values:np.ndarray, order:np.ndarray):
+    out = np.empty_like(values)
+    np.put_along_axis(out, order, values, axis=1)
+    return out
+
+#Function to compact only the gapped columns. Returns the arrays with the
+#compacted rows and their order, rows is None when nothing was moved
+def compact_gapped(values:np.ndarray, valid:np.ndarray):
+    rows = np.flatnonzero(gapped_columns(valid))
+    if len(rows) == 0:
+        return values, valid, None, None
+
+    values, valid = values.copy(), valid.copy()
+    values[rows], valid[rows], order = compact_rows(values[rows], valid[rows])
+    return values, valid, rows, order
+
+#Cumulative sums along each row with a leading zero
+def prefix_sums(values:np.ndarray):
+    out = np.zeros((values.shape[0], values.shape[1] + 1))
+    np.cumsum(values, axis=1, out=out[:, 1:])
+    return out
+
+#Change over the previous observation of each row
+def observation_returns(values:np.ndarray, valid:np.ndarray):
+    returns = np.empty(values.shape)
+    returns[:, :1] = np.nan
+    with np.errstate(divide='ignore', invalid='ignore'):
+        np.divide(values[:, 1:], values[:, :-1], out=returns[:, 1:])
+    returns[:, 1:] -= 1
+    ok = np.zeros(valid.shape, dtype=bool)
+    np.logical_and(valid[:, 1:], valid[:, :-1], out=ok[:, 1:])
+    ok &= np.isfinite(returns)
+    return returns, ok
+
+#Windows of n observations over the rows of values. Cumulative sums, masks
+#of full windows and moments are kept, so every statistic and window length
+#of a request shares them. rows and order map compacted rows back,
+#contiguous tells the valid values of every row are known to be one run,
+#center=False skips centering values that are close to zero already
+class Windows:
+    def __init__(self, values:np.ndarray, valid:np.ndarray, rows=None, order=None, contiguous=None, center=True):
+        self.values = values
+        self.valid = valid
+        self.centering = center
+        self.rows = rows
+        self.order = order
+        self.prefixes = {}
+        self.masks = {}
+        self.means = {}
+        self.variances = {}
+
+        #rows holding one run of valid values have their full windows
+        #located from the ends of the run, others count valid values
+        self.count = valid.sum(axis=1)
+        if contiguous is None:
+            contiguous = not gapped_columns(valid, self.count).any()
+        if valid.shape[1] == 0 or not contiguous:
+            self.counts = prefix_sums(valid)
+        else:
+            self.counts = None
+            self.first = valid.argmax(axis=1)[:, None]
+            self.last = self.first + self.count[:, None]
+
+    #Keeps the cumulative sums of values under key, values outside valid
+    #count as zero. values can be a single row shared by every column with
+    #its own valid mask, or valid None when values are zero there already
+    def add(self, key, values:np.ndarray, valid:np.ndarray=None):
+        if key not in self.prefixes:
+            self.prefixes[key] = prefix_sums(values if valid is None else np.where(valid, values, 0.0))
+
+    #Mask of the positions that do not end a window of n valid observations
+    def partial(self, n:int):
+        if n not in self.masks:
+            if self.counts is None:
+                positions = np.arange(self.valid.shape[1])
+                partial = (positions < self.first + n - 1) | (positions >= self.last)
+            else:
+                partial = np.ones(self.valid.shape, dtype=bool)
+                if n <= self.valid.shape[1]:
+                    partial[:, n - 1:] = (self.counts[:, n:] - self.counts[:, :-n]) != n
+            self.masks[n] = partial
+        return self.masks[n]
+
+    #Sums of the last n values added under key, NaN unless the window is full
+    def sums(self, key, n:int):
+        partial = self.partial(n)
+        out = np.empty(partial.shape)
+        if n <= partial.shape[1]:
+            prefix = self.prefixes[key]
+            np.subtract(prefix[:, n:], prefix[:, :-n], out=out[:, n - 1:])
+        np.copyto(out, np.nan, where=partial)
+        return out
+
+    #Rolling mean of the rows centered on their overall mean. Centering
+    #keeps the sum of squares from cancelling out on series with a large level
+    def centered_mean(self, n:int):
+        if n not in self.means:
+            if 'centered' not in self.prefixes:
+                self.centered = np.where(self.valid, self.values, 0.0)
+                self.center = np.zeros((len(self.values), 1))
+                if self.centering:
+                    self.center = self.centered.sum(axis=1, keepdims=True) / np.maximum(self.count, 1)[:, None]
+                    np.subtract(self.centered, self.center, out=self.centered, where=self.valid)
+                self.add('centered', self.centered)
+            mean = self.sums('centered', n)
+            mean /= n
+            self.means[n] = mean
+        return self.means[n]
+
+    #Rolling sample variance
+    def variance(self, n:int):
+        if n not in self.variances:
+            mean = self.centered_mean(n)
+            self.add('squares', self.centered * self.centered)
+            square = mean * mean
+            square *= n
+            var = self.sums('squares', n)
+            var -= square
+            var /= max(n - 1, 1)
+            self.variances[n] = np.maximum(var, 0, out=var)
+        return self.variances[n]
+
+    #Function to move a result of the compacted rows back to their positions
+    def expand(self, result:np.ndarray):
+        if self.rows is not None:
+            result[self.rows] = expand_rows(result[self.rows], self.order)
+        return result
+
+#Windows of the changes of the columns and of a base series, taken over the
+#observations each column shares with the base. Columns without gaps in
+#those observations share a single row of base changes, the gapped ones are
+#compacted and get the base taken along their own order
+class CorrWindows:
+    def __init__(self, values:np.ndarray, valid:np.ndarray, base:np.ndarray):
+        base_valid = np.isfinite(base)
+        pair = valid & base_valid
+        gapped = gapped_columns(pair)
+        self.shape = values.shape
+        self.groups = []
+
+        rows = np.flatnonzero(~gapped)
+        if len(rows) > 0:
+            x, x_ok = observation_returns(values[rows], pair[rows])
+            y, y_ok = observation_returns(base[None, :], base_valid[None, :])
+            self.groups.append((rows, None, self.windows(x, x_ok, y, y_ok)))
+
+        rows = np.flatnonzero(gapped)
+        if len(rows) > 0:
+            x, ok, order = compact_rows(values[rows], pair[rows])
+            y = np.take_along_axis(np.broadcast_to(base, (len(rows), len(base))), order, axis=1)
+            x, x_ok = observation_returns(x, ok)
+            y, y_ok = observation_returns(y, ok)
+            self.groups.append((rows, order, self.windows(x, x_ok, y, y_ok)))
+
+    #Windows counting the positions where both changes are valid. Inside a
+    #full window the base is valid too, so its sums need no per column mask
+    @staticmethod
+    def windows(x, x_ok, y, y_ok):
+        windows = Windows(x, x_ok & y_ok)
+        x = np.where(windows.valid, x, 0.0)
+        y = np.where(y_ok, y, 0.0)
+        windows.add('x', x)
+        windows.add('xx', x * x)
+        windows.add('xy', x * y)
+        windows.add('y', y)
+        windows.add('yy', y * y)
+        return windows
+
+    def corr(self, n:int):
+        out = np.empty(self.shape)
+        for rows, order, windows in self.groups:
+            sx, sy = windows.sums('x', n), windows.sums('y', n)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                cov = windows.sums('xy', n) - sx * sy / n
+                var_x = windows.sums('xx', n) - sx**2 / n
+                var_y = windows.sums('yy', n) - sy**2 / n
+                result = cov / np.sqrt(var_x * var_y)
+            out[rows] = result if order is None else expand_rows(result, order)
+        return out
+
+#Names of the rolling transformations: RollMean12, RollVol12, ZScore12
+#(window in observations), Drawdown and RollCorr12:SP500, the correlation
+#with the base series named after the colon
+rolling_names = re.compile(r'^(RollMean|RollVol|ZScore|RollCorr)([1-9]\d*)(?::(.+))?$|^(Drawdown)$')
+period_trans = ['YoY', 'QoQ', 'MoM']
+
+#Function to read a rolling transformation name into (kind, window, base),
+#None when it is not a valid one. Only RollCorr takes a base, and needs it
+def rolling_parts(name:str):
+    match = rolling_names.match(name)
+    if match is None:
+        return None
+    kind, window, base, drawdown = match.groups()
+    if drawdown is not None:
+        return drawdown, None, None
+    if (kind == 'RollCorr') != (base is not None):
+        return None
+    return kind, int(window), base
+
+#Base series of the RollCorr transformations in trans
+def corr_bases(trans:list):
+    parts = [rolling_parts(name) for name in trans if name not in period_trans]
+    return list(dict.fromkeys(x[2] for x in parts if x is not None and x[2] is not None))
 
 
 class Transformations:
     def __init__(self):
         pass
 
+    #Function to split a trans list into period changes and rolling statistics
+    def split_trans(self, trans:list):
+        period = [x for x in trans if x in period_trans]
+        rolling = [x for x in trans if x not in period_trans]
+        for name in rolling:
+            if rolling_parts(name) is None:
+                raise ValueError(f'Unknown transformation {name}')
+        return period, rolling
+
+    #Function to compute rolling statistics of many columns at once. Returns
+    #the columns (named tran_column) aligned to the rows of the frame passed.
+    #RollVol is the standard deviation of the changes between observations,
+    #RollCorr the correlation of those changes with its base column, which
+    #has to be in frame but not necessarily in columns
+    def rolling_stats(self, frame:pd.DataFrame, columns:list, trans:list):
+        if len(trans) == 0 or len(columns) == 0:
+            return pd.DataFrame(index=frame.index)
+
+        try:
+            values = frame[columns].to_numpy(dtype='float64')
+        except (TypeError, ValueError):
+            values = frame[columns].apply(pd.to_numeric, errors='coerce').to_numpy(dtype='float64')
+        #one row per column so each window runs over contiguous memory
+        values = np.ascontiguousarray(values.T)
+
+        #after compaction the valid values of every column are one run
+        levels = Windows(*compact_gapped(values, np.isfinite(values)), contiguous=True)
+        returns = None
+        bases = {}
+
+        #each statistic is written to its rows of stats, then moved back
+        #from the compacted positions
+        stats = np.empty((len(trans) * len(columns), len(frame)))
+        for i, name in enumerate(trans):
+            kind, n, base = rolling_parts(name)
+            out = stats[i * len(columns):(i + 1) * len(columns)]
+
+            if kind == 'Drawdown':
+                peaks = np.fmax.accumulate(np.where(levels.valid, levels.values, np.nan), axis=1)
+                np.divide(levels.values, peaks, out=out)
+                out -= 1
+                np.copyto(out, np.nan, where=~levels.valid)
+                levels.expand(out)
+            elif kind == 'RollMean':
+                np.add(levels.centered_mean(n), levels.center, out=out)
+                levels.expand(out)
+            elif kind == 'ZScore':
+                mean = levels.centered_mean(n)
+                np.subtract(levels.centered, mean, out=out)
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    out /= np.sqrt(levels.variance(n))
+                levels.expand(out)
+            elif kind == 'RollVol':
+                if returns is None:
+                    returns = Windows(*observation_returns(levels.values, levels.valid), levels.rows, levels.order, center=False)
+                np.sqrt(returns.variance(n), out=out)
+                returns.expand(out)
+            else:
+                if base not in frame.columns:
+                    raise BadRequest(f'{name}: base series {base} is not loaded')
+                if base not in bases:
+                    base_values = pd.to_numeric(frame[base], errors='coerce').to_numpy(dtype='float64')
+                    bases[base] = CorrWindows(values, np.isfinite(values), base_values)
+                out[:] = bases[base].corr(n)
+
+        names = [f'{name}_{col}' for name in trans for col in columns]
+        return pd.DataFrame(stats.T, index=frame.index, columns=names, copy=False)
+
     def periodical_change(self, s, months=12):
         shifted = s.shift(freq=pd.DateOffset(months=months))
         pct_change = (s - shifted) / shifted
@@ -46,6 +746,107 @@ class Transformations:
 
         return True
 
+    #Function to compute the period changes of many columns in one pass
+    #over a shared DatetimeIndex. Returns the change columns (named
+    #freq_column) aligned to the rows of the frame passed
+    def batch_changes(self, frame:pd.DataFrame, date_col:str, columns:list, freqs:list):
+
+        freq_months = {'YoY':12, 'QoQ':3, 'MoM':1}
+
+        dates = pd.DatetimeIndex(pd.to_datetime(frame[date_col]))
+        values = frame[columns].set_axis(dates, axis=0)
+        values = values.apply(pd.to_numeric, errors='coerce')
+        values = values[~values.index.duplicated(keep='last')].sort_index()
+
+        changes = []
+        for freq in freqs:
+            shifted = values.shift(freq=pd.DateOffset(months=freq_months[freq]))
+            #month end offsets can land several dates on the same day, the latest
+            #observation of each column wins as in admin.changes_query
+            shifted = shifted.groupby(level=0).last().reindex(values.index)
+            #a zero base has no change, NULLIF in the query
+            shifted = shifted.where(shifted != 0)
+
+            change = (values - shifted) / shifted
+            change.columns = [freq + '_' + col for col in columns]
+            changes.append(change)
+
+        changes = pd.concat(changes, axis=1).reindex(dates)
+        changes.index = frame.index
+
+        return changes
+
+    #Function to bring persisted changes up to date. values is the wide frame
+    #of current values (sorted DatetimeIndex, one column per key) and stored
+    #the long frame read from a ChangesTable. Current values are compared with
+    #the ones the stored changes were computed from, and only keys with new
+    #or revised values are recomputed and persisted, from their first change.
+    #Recomputed rows always get every change column, so the persisted yoy,
+    #qoq and mom match the persisted value whichever freqs were requested.
+    #Rows before complete_from lack the lookback when values are a window of
+    #the history, they are served but not persisted.
+    #Returns the wide change columns (freq_key) and the long rows to persist
+    def incremental_changes(self, values:pd.DataFrame, stored:pd.DataFrame, key:str, freqs:list, complete_from=None):
+
+        freq_months = {'YoY':12, 'QoQ':3, 'MoM':1}
+        names = {freq: freq.lower() for freq in freq_months}
+        columns = [key, 'date', 'value'] + list(names.values())
+
+        if len(stored) == 0 or not set(names.values()) <= set(stored.columns):
+            #Tables missing a change column are recomputed for the full history
+            stored = pd.DataFrame(columns=columns)
+            stored['date'] = pd.to_datetime(stored['date'])
+        stored = stored[stored[key].isin(values.columns)]
+
+        #The whole history is compared in one pass so revisions of old values
+        #are found too, each key is recomputed from its first changed date.
+        #Values with nothing stored count as changed
+        stored_values = stored.groupby(['date', key])['value'].last().unstack(key)
+        stored_values = stored_values.reindex(index=values.index, columns=values.columns).astype('float64')
+        differs = values.notna() & ~(values == stored_values)
+        first = differs.idxmax()[differs.any()]
+
+        updates = pd.DataFrame(columns=columns)
+        if len(first) > 0:
+            lookback = pd.DateOffset(months=max(freq_months.values()))
+            tail = values.loc[first.min() - lookback:, list(first.index)]
+
+            changes = self.batch_changes(tail.reset_index(names='date'), 'date', list(first.index), list(names))
+            changes.index = tail.index
+            parts = {'value': tail}
+            for freq, name in names.items():
+                parts[name] = changes[[freq + '_' + col for col in first.index]].set_axis(list(first.index), axis=1)
+
+            updates = pd.concat(parts, axis=1).stack(level=1, future_stack=True)
+            updates = updates.rename_axis(['date', key]).reset_index().dropna(subset=['value'])
+            updates = updates[updates['date'] >= updates[key].map(first)]
+
+        kept = stored[~(stored['date'] >= stored[key].map(first))] if len(first) > 0 else stored
+        combined = pd.concat([kept, updates], ignore_index=True)
+
+        if complete_from is not None:
+            persist = updates[updates['date'] >= complete_from]
+        else:
+            persist = updates
+
+        return self.wide_changes(combined, values, key, freqs), persist[columns]
+
+    #Function to turn long changes (key, date, yoy, qoq, mom) into change
+    #columns named freq_key aligned to the rows and columns of values
+    def wide_changes(self, changes:pd.DataFrame, values:pd.DataFrame, key:str, freqs:list):
+        changes = changes.set_index(['date', key])
+
+        wide = []
+        for freq in freqs:
+            if freq.lower() in changes.columns:
+                column = changes[freq.lower()].unstack(key).reindex(index=values.index, columns=values.columns)
+            else:
+                column = pd.DataFrame(index=values.index, columns=values.columns)
+            column.columns = [freq + '_' + str(col) for col in column.columns]
+            wide.append(column.astype('float64'))
+
+        return pd.concat(wide, axis=1)
+
     def YoY(self, series_df:pd.DataFrame, date_col:str, value_col:str, attr_name:str):
         return self.Changes(series_df, date_col, value_col, attr_name, freq='YoY')
 
@@ -56,106 +857,195 @@ class Transformations:
         return self.Changes(series_df, date_col, value_col, attr_name, freq='MoM')
 
 class EconData(Transformations):
-    def __init__(self, series_ids:list, trans=['YoY', 'QoQ', 'MoM']):
+    #changes='table' keeps the changes persisted in econ_hist_changes and only
+    #recomputes them from the first new or revised date of each series,
+    #changes='view' reads them from econ_hist_changes_view as of its last refresh
+    def __init__(self, series_ids:list, trans=['YoY', 'QoQ', 'MoM'], read_through=True, max_age=fresh_window, load=True, changes='compute'):
 
         self.series_ids = series_ids
-        self.observations = fred.Observations(self.series_ids)
-        self.series_meta = fred.SeriesMeta(self.series_ids)
-        self.series_release = fred.SeriesRelease(self.series_ids)
+        #RollCorr bases are loaded with the series but not returned
+        self.load_ids = list(dict.fromkeys(list(series_ids) + corr_bases(trans)))
+        self.observations = fred.Observations(self.load_ids)
+        self.series_meta = fred.SeriesMeta(self.load_ids)
+        self.series_release = fred.SeriesRelease(self.load_ids)
         self.trans = trans
         self.applied_trans = []
+        self.read_through = read_through
+        self.max_age = max_age
+        self.changes = changes
 
-        self.get_data()
+        if load == True:
+            self.get_data()
 
         Transformations.__init__(self)
 
+    #Async constructor, the API requests fan out on the shared loop and the
+    #database and pandas work runs in worker threads
+    @classmethod
+    async def create(cls, series_ids:list, **kwargs):
+        obj = cls(series_ids, load=False, **kwargs)
+        await obj.async_get_data()
+        return obj
+
+    #Release data is not part of the api payload, only request it when used
+    @property
+    def release_data(self):
+        if not hasattr(self, '_release_data'):
+            self._release_data = self.series_release.data()
+        return self._release_data
+
+    #Function to read observations and metadata from the local store, returns
+    #them with the series that are missing or stale
+    def stored_frames(self):
+        raw_data = self.observations.stored()
+        meta_data = self.series_meta.stored()
+
+        #FRED stamps realtime_start with the date of the request
+        cutoff = (date.today() - self.max_age).strftime('%Y-%m-%d')
+        fetched = raw_data.groupby('id')['realtime_start'].max()
+        fresh = set(fetched[fetched >= cutoff].index) & set(meta_data.id)
+        stale = [x for x in self.load_ids if x not in fresh]
+
+        return raw_data, meta_data, stale
+
+    #Function to load the stored frames, or nothing when the API is the only source
+    def initial_frames(self):
+        if self.read_through == True:
+            return self.stored_frames()
+        return None, None, list(self.load_ids)
+
+    #Release is only part of the fan out when every series is requested
+    def fan_out_release(self, stale:list):
+        return len(stale) == len(self.load_ids)
+
+    #Function to parse the API responses of the stale series and merge them
+    #over the stored frames, the new data is written back when reading through
+    def merge_fetched(self, raw_data, meta_data, stale:list, responses:dict):
+        observations = fred.Observations(stale)
+        series_meta = fred.SeriesMeta(stale)
+        new_data = observations.data(raw_data=responses['observations'])
+        new_meta = series_meta.data(raw_data=responses['meta'])
+        if 'release' in responses:
+            self._release_data = self.series_release.data(raw_data=responses['release'])
+
+        if raw_data is None:
+            return new_data, new_meta
+
+        try:
+            for obj in [observations, series_meta]:
+                obj.create_table()
+                obj.upsert_async()
+        except Exception as e:
+            #Serving the request does not depend on the write back
+            print('Error storing series', stale, e)
+
+        raw_data = pd.concat([raw_data[~raw_data.id.isin(stale)], new_data])
+        meta_data = pd.concat([meta_data[~meta_data.id.isin(stale)], new_meta])
+
+        return raw_data, meta_data
+
     def get_data(self):
-        raw_data = self.observations.data()
+        raw_data, meta_data, stale = self.initial_frames()
+
+        if len(stale) > 0:
+            responses = fred.series_responses(stale, release=self.fan_out_release(stale))
+            raw_data, meta_data = self.merge_fetched(raw_data, meta_data, stale, responses)
+
+        self.meta_data = meta_data.reset_index(drop=True)
+        self.build_frames(raw_data)
+
+        return True
+
+    async def async_get_data(self):
+        raw_data, meta_data, stale = await asyncio.to_thread(self.initial_frames)
+
+        if len(stale) > 0:
+            responses = await fred.async_series_responses(stale, release=self.fan_out_release(stale))
+            raw_data, meta_data = await asyncio.to_thread(self.merge_fetched, raw_data, meta_data, stale, responses)
 
+        self.meta_data = meta_data.reset_index(drop=True)
+        await asyncio.to_thread(self.build_frames, raw_data)
+
+        return True
+
+    #Function to pivot the observations and set one frame per series
+    def build_frames(self, raw_data):
         self.historical_data = raw_data.groupby(['id', 'date'])['value'].last().unstack('id')
         self.historical_data.index = pd.to_datetime(self.historical_data.index)
         self.historical_data.reset_index(inplace=True)
+        self.series_cols = [x for x in self.historical_data.columns if x != 'date']
 
         for column in self.historical_data.columns:
             temp = self.historical_data[['date', column]].dropna()
             self.__setattr__( column, temp)
 
-        self.meta_data = self.series_meta.data()
-
-        self.release_data = self.series_release.data()
-
         return True
 
     def apply_transformations(self):
-        for tran in self.trans:
-            if tran not in self.applied_trans:
-                self.applied_trans.append(tran)
-                for column in self.historical_data.columns:
-                    if column != 'date':
-                        self.__getattribute__(tran)(self.historical_data, 'date', column, column)
-                else:
-                    pass
-    
+        trans = [x for x in self.trans if x not in self.applied_trans]
+        if len(trans) == 0:
+            return True
+        self.applied_trans += trans
+
+        period, rolling = self.split_trans(trans)
+        changes = [self.rolling_stats(self.historical_data, self.series_cols, rolling)]
+        if len(period) == 0:
+            pass
+        elif self.changes == 'table':
+            changes.append(self.table_changes(period))
+        elif self.changes == 'view':
+            changes.append(self.view_changes(period))
+        else:
+            changes.append(self.batch_changes(self.historical_data, 'date', self.series_cols, period))
+        self.historical_data = pd.concat([self.historical_data] + changes, axis=1)
+
+        for column in self.series_cols:
+            cols = ['date', column] + [tran + '_' + column for tran in self.applied_trans]
+            temp = self.historical_data[cols].dropna(subset=[column])
+            self.__setattr__(column, temp)
+
         return True
 
-    def api_json(self):
-        series = {}
-        for _ in self.series_ids:
-            # copy the DataFrame and coerce types to JSON-safe values
-            df = getattr(self, _).copy()
+    #Function to read the persisted changes, recompute the tail of the
+    #series with new or revised observations and write it back
+    def table_changes(self, trans:list):
+        table = fred.ObservationChanges()
+        values = self.historical_data.set_index('date')[self.series_cols].apply(pd.to_numeric, errors='coerce')
 
-            # convert any pandas Timestamp-like objects to ISO strings for portability
-            if 'date' in df.columns:
-                try:
-                    df['date'] = df['date'].apply(lambda x: x.isoformat() if hasattr(x, 'isoformat') else (str(x) if pd.notnull(x) else None))
-                except Exception:
-                    df['date'] = df['date'].astype(str)
-
-            # replace infinite values with None and null-out NaNs
-            df = df.replace([np.inf, -np.inf], None)
-            df = df.where(pd.notnull(df), None)
-
-            # convert numpy scalar types to native python types and ensure everything is JSON-serializable
-            raw = df.to_dict(orient='list')
-            safe = {}
-            for k, lst in raw.items():
-                safe_list = []
-                for v in lst:
-                    if v is None:
-                        safe_list.append(None)
-                        continue
-                    # pandas / numpy timestamp
-                    if hasattr(v, 'isoformat'):
-                        try:
-                            safe_list.append(v.isoformat())
-                            continue
-                        except Exception:
-                            pass
-                    # numpy scalar -> python native
-                    if isinstance(v, (np.generic,)):
-                        try:
-                            safe_list.append(v.item())
-                            continue
-                        except Exception:
-                            pass
-                    # builtin numeric/bool/str
-                    if isinstance(v, (int, float, str, bool)):
-                        # guard against non-finite floats
-                        if isinstance(v, float) and (np.isinf(v) or np.isnan(v)):
-                            safe_list.append(None)
-                        else:
-                            safe_list.append(v)
-                        continue
-                    # fallback: stringify
-                    try:
-                        safe_list.append(float(v))
-                    except Exception:
-                        safe_list.append(str(v))
-                safe[k] = safe_list
+        changes, updates = self.incremental_changes(values, table.stored(self.series_cols), 'id', trans)
+
+        try:
+            table.post(updates)
+        except Exception as e:
+            #Serving the request does not depend on the write back
+            print('Error storing changes', self.series_cols, e)
+
+        changes.index = self.historical_data.index
+        return changes
+
+    #Function to read the changes computed by the database
+    def view_changes(self, trans:list):
+        values = self.historical_data.set_index('date')[self.series_cols]
+        stored = fred.ObservationChangesView().stored(self.series_cols)
 
+        changes = self.wide_changes(stored, values, 'id', trans)
+        changes.index = self.historical_data.index
+        return changes
+
+    #Function returning the encoded metadata and the frame of each series
+    def series_frames(self):
+        frames = {}
+        for _ in self.series_ids:
+            meta = self.meta_data[self.meta_data.id == _].to_json(orient='records')
+            frames[_] = (meta, getattr(self, _))
+        return frames
+
+    def api_json(self):
+        series = {}
+        for _, (meta, frame) in self.series_frames().items():
             series[_] = {
-                'meta': self.meta_data[self.meta_data.id == _].to_dict(orient='records'),
-                'data': safe
+                'meta': json.loads(meta),
+                'data': column_lists(frame)
             }
         return series
 
@@ -163,11 +1053,17 @@ class EconData(Transformations):
 
 
 class MarketData(Transformations):
-    def __init__(self, symbol_list:list, from_date='1900-01-01', trans=['YoY']):
+    #changes='table' keeps the changes persisted in hist_changes and
+    #changes='view' reads them from hist_changes_view, see EconData
+    def __init__(self, symbol_list:list, from_date='1900-01-01', trans=['YoY'], read_through=True, changes='compute'):
         self.symbols = symbol_list
+        #RollCorr bases are loaded with the symbols but not returned
+        self.load_symbols = list(dict.fromkeys(list(symbol_list) + corr_bases(trans)))
         self.from_date = from_date
         self.trans = trans
         self.applied_trans = []
+        self.read_through = read_through
+        self.changes = changes
 
 
         self.get_historical()
@@ -175,42 +1071,101 @@ class MarketData(Transformations):
 
         Transformations.__init__(self)
 
-    def get_historical(self):
+    #Function to read the prices from the historical table, symbols
+    #with nothing stored are downloaded from the API
+    def stored_data(self):
         obj = eod.Historical()
+        frame = obj.stored(self.load_symbols, from_date=self.from_date)
+
+        missing = [x for x in self.load_symbols if x not in set(frame.symbol.unique())]
+        if len(missing) > 0:
+            fetched = obj.data(missing, from_date=self.from_date)
+            frame = pd.concat([frame, fetched[frame.columns]], ignore_index=True)
 
-        self.historical_data = obj.data(self.symbols, from_date=self.from_date)
+        return frame
+
+    def get_historical(self):
+        if self.read_through == True:
+            self.historical_data = self.stored_data()
+        else:
+            self.historical_data = eod.Historical().data(self.load_symbols, from_date=self.from_date)
 
         self.historical_data.date = pd.to_datetime(self.historical_data.date)
+        self.historical_data['symbol'] = self.historical_data.symbol.astype('category')
 
-        for symbol in self.historical_data.symbol.unique():
-            temp = self.historical_data[self.historical_data.symbol == symbol].drop(columns=['symbol']).set_index('date')
-            self.__setattr__(symbol, temp.reset_index())
+        #one pass split into per symbol frames
+        for symbol, temp in self.historical_data.groupby('symbol', observed=True, sort=False):
+            self.__setattr__(symbol, temp.drop(columns=['symbol']).reset_index(drop=True))
 
         return True
 
     def get_meta(self):
-        db_obj = db('', [])
-
-        with db_obj.engine().connect() as conn:
-            query = f'''SELECT * FROM exchange WHERE code IN ({', '.join([f"'{sym}'" for sym in self.symbols])})'''
-            self.meta_data = pd.read_sql_query(query, conn)
+        query = '''SELECT * FROM exchange WHERE code = ANY($1::varchar[]);'''
+        #the cached frame is shared, keep a copy callers can modify
+        self.meta_data = eod.cached_lookup(query, list(self.symbols), frame=True).copy()
 
         return True
 
 
     def apply_transformations(self):
-        for tran in self.trans:
-            if tran not in self.applied_trans:
-                self.applied_trans.append(tran)
-                for symbol in self.symbols:
-                    self.__getattribute__(tran)(getattr(self, symbol), 
-                                                'date',
-                                                'adjusted_close', 
-                                                symbol)
-                else:
-                    pass
+        trans = [x for x in self.trans if x not in self.applied_trans]
+        if len(trans) == 0:
+            return True
+        self.applied_trans += trans
+
+        prices = self.historical_data.groupby(['date', 'symbol'], observed=True)['adjusted_close'].last().unstack('symbol')
+        loaded = [x for x in self.load_symbols if x in prices.columns]
+        prices = prices[loaded].set_axis(loaded, axis=1)
+        symbols = [x for x in self.symbols if x in prices.columns]
+        period, rolling = self.split_trans(trans)
+
+        #RollCorr bases are read from all loaded prices, changes cover the symbols
+        changes = [self.rolling_stats(prices, symbols, rolling)]
+        prices = prices[symbols]
+        if len(period) == 0:
+            pass
+        elif self.changes == 'table':
+            changes.append(self.table_changes(prices, period))
+        elif self.changes == 'view':
+            stored = eod.HistoricalChangesView().stored(symbols, from_date=self.from_date)
+            changes.append(self.wide_changes(stored, prices, 'symbol', period))
+        else:
+            period_changes = self.batch_changes(prices.reset_index(), 'date', symbols, period)
+            period_changes.index = prices.index
+            changes.append(period_changes)
+        changes = pd.concat(changes, axis=1)
+
+        for symbol in symbols:
+            temp = getattr(self, symbol)
+            for tran in trans:
+                temp[tran + '_adjusted_close'] = changes[tran + '_' + symbol].reindex(temp.date).to_numpy()
+
         return True
 
+    #Function to read the persisted changes of the adjusted close, recompute
+    #the tail of the symbols with new or revised prices and write it back.
+    #When from_date cuts the history the first rows lack the lookback and
+    #are not persisted
+    def table_changes(self, prices:pd.DataFrame, trans:list):
+        table = eod.HistoricalChanges()
+        prices = prices.set_axis([str(x) for x in prices.columns], axis=1)
+        stored = table.stored(list(prices.columns))
+
+        complete_from = None
+        if len(prices) > 0 and pd.Timestamp(self.from_date) > pd.Timestamp('1900-01-01'):
+            #every change column is persisted, YoY has the longest lookback
+            complete_from = prices.index.min() + pd.DateOffset(months=12)
+
+        changes, updates = self.incremental_changes(prices, stored, 'symbol', trans, complete_from)
+
+        try:
+            table.post(updates)
+        except Exception as e:
+            #Serving the request does not depend on the write back
+            print('Error storing changes', list(prices.columns), e)
+
+        return changes
+
     def api_json(self):
         series = {}
         for symbol in self.symbols:
@@ -221,7 +1176,8 @@ class MarketData(Transformations):
         return series
 
 class OverlayData(Transformations):
-    def __init__(self, econ_ids:list, market_symbols:list, market_driver='adjusted_close',from_date='1900-01-01', trans=['YoY']):
+    def __init__(self, econ_ids:list, market_symbols:list, market_driver='adjusted_close',from_date='1900-01-01', trans=['YoY'],
+                 align='union', fill=None, fill_limit=None, tolerance=None):
         self.econ_ids = econ_ids
         self.market_symbols = market_symbols
         self.econ_data = EconData(econ_ids)
@@ -229,53 +1185,124 @@ class OverlayData(Transformations):
         self.market_driver = market_driver
         self.trans = trans
         self.applied_trans = []
+        self.alignment = align
+        self.fill = fill
+        self.fill_limit = fill_limit
+        self.tolerance = pd.Timedelta(tolerance) if tolerance is not None else None
 
 
         self.get_historical()
 
         Transformations.__init__(self)
 
-    def get_historical(self):
-        self.econ_data.get_data()
-        self.market_data.get_historical()
+    #Function to align the economic and market columns on observed dates only.
+    #align='union' keeps every date observed on either side, fill='ffill' carries
+    #values forward over the other side's dates (at most fill_limit rows).
+    #align='market' or 'econ' keeps the dates of that side and joins the other
+    #one as of each date, values older than tolerance are left empty
+    def align(self, econ_data:pd.DataFrame, market_data:pd.DataFrame):
+        if self.alignment == 'union':
+            aligned = pd.concat([econ_data, market_data], axis=1).sort_index()
+            if self.fill == 'ffill':
+                aligned = aligned.ffill(limit=self.fill_limit)
+            aligned.index.name = 'date'
+            return aligned.reset_index()
+
+        left, right = (market_data, econ_data) if self.alignment == 'market' else (econ_data, market_data)
+        return pd.merge_asof(left.reset_index(), right.reset_index(), on='date',
+                             direction='backward', tolerance=self.tolerance)
 
-        econ_data = self.econ_data.historical_data.copy()
-        econ_data.date = pd.to_datetime(econ_data.date)
-        econ_data.set_index('date', inplace=True)
+    def get_historical(self):
+        #Both sides are loaded by their constructors
+        econ_data = self.econ_data.historical_data.set_index('date')
+        econ_data.index = pd.to_datetime(econ_data.index)
+        econ_data.index.name = 'date'
 
-        market_data = self.market_data.historical_data.groupby(['symbol', 'date'])[self.market_driver].last().unstack('symbol')
+        market_data = self.market_data.historical_data.groupby(['symbol', 'date'], observed=True)[self.market_driver].last().unstack('symbol')
         market_data.index = pd.to_datetime(market_data.index)
+        market_data.index.name = 'date'
+        market_data.columns = [str(x) for x in market_data.columns]
 
-        min_date = min(econ_data.index.min(), market_data.index.min())
-        max_date = max(econ_data.index.max(), market_data.index.max())
-        date_range = pd.date_range(start=min_date, end=max_date, freq='D')
+        self.historical_data = self.align(econ_data.sort_index(), market_data.sort_index())
+
+        return True
 
 
-        historical_data = pd.DataFrame(index=date_range)
-        historical_data = historical_data.merge(econ_data, left_index=True, right_index=True, how='left')
-        historical_data = historical_data.merge(market_data, left_index=True, right_index=True, how='left')
-        historical_data.index.name = 'date'
-        historical_data.reset_index(inplace=True)
+    def apply_transformations(self):
+        trans = [x for x in self.trans if x not in self.applied_trans]
+        if len(trans) == 0:
+            return True
+        self.applied_trans += trans
 
+        columns = [x for x in (self.econ_ids + self.market_symbols) if x in self.historical_data.columns]
+        period, rolling = self.split_trans(trans)
 
-        self.historical_data = historical_data
+        #RollCorr bases have to be one of the econ ids or market symbols
+        changes = [self.rolling_stats(self.historical_data, columns, rolling)]
+        if len(period) > 0:
+            changes.append(self.batch_changes(self.historical_data, 'date', columns, period))
+        self.historical_data = pd.concat([self.historical_data] + changes, axis=1)
 
         return True
 
 
-    def apply_transformations(self):
-        for tran in self.trans:
-            if tran not in self.applied_trans:
-                self.applied_trans.append(tran)
-                for _ in (self.econ_ids + self.market_symbols):
-                    self.__getattribute__(tran)(getattr(self, 'historical_data'), 
-                                                'date',
-                                                _, 
-                                                'historical_data')
-                else:
-                    pass
-        return True 
+#Process wide cache of computed series payloads
+payload_cache = PayloadCache()
+
+#Cache keys of the series. Keys need no database lookup so a hit costs
+#no query, updates to the stored series are served once the entry
+#expires (payload_cache.ttl)
+def series_keys(series_ids:list, trans:tuple):
+    return {(sid, trans): sid for sid in series_ids}
+
+#Function to compute the cache entries of the missing keys from a loaded EconData
+def series_entries(obj, keys:dict, missing:list):
+    obj.apply_transformations()
+    frames = obj.series_frames()
+
+    computed = {}
+    for key in missing:
+        meta, frame = frames[keys[key]]
+        computed[key] = (frames[keys[key]], int(frame.memory_usage(deep=True).sum()) + len(meta))
+    return computed
+
+#Function returning the encoded metadata and frame of the series requested,
+#serving series already computed for the same transformations from the
+#payload cache. Cached frames are shared between requests and must not be modified
+def econ_series(series_ids:list, trans=('YoY', 'QoQ', 'MoM')):
+    trans = tuple(trans)
+    keys = series_keys(series_ids, trans)
+
+    def compute(missing):
+        obj = EconData([keys[key] for key in missing], trans=list(trans))
+        return series_entries(obj, keys, missing)
+
+    cached = payload_cache.get_many(list(keys), compute)
+
+    return {sid: cached[key] for key, sid in keys.items()}
+
+#Async version of econ_series, the requests of all missing series fan out
+#concurrently on the shared loop
+async def async_econ_series(series_ids:list, trans=('YoY', 'QoQ', 'MoM')):
+    trans = tuple(trans)
+    keys = series_keys(series_ids, trans)
+
+    async def compute(missing):
+        obj = await EconData.create([keys[key] for key in missing], trans=list(trans))
+        return await asyncio.to_thread(series_entries, obj, keys, missing)
 
+    cached = await payload_cache.async_get_many(list(keys), compute)
 
+    return {sid: cached[key] for key, sid in keys.items()}
 
+#Function to build the api payload of the series requested
+def econ_payload(series_ids:list, trans=('YoY', 'QoQ', 'MoM')):
+    series = {}
+    for sid, (meta, frame) in econ_series(series_ids, trans).items():
+        series[sid] = {'meta': json.loads(meta), 'data': column_lists(frame)}
+    return series
 
+#Function to build the aligned payload of the series requested
+def econ_aligned(series_ids:list, trans=('YoY', 'QoQ', 'MoM'), encoding='compact', **window):
+    frames = window_frames(econ_series(list(dict.fromkeys(series_ids)), trans), **window)
+    return encode_aligned(frames, encoding)
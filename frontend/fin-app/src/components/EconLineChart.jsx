@@ -22,6 +22,9 @@ const COLORS = [
   'rgba(153,102,255,0.95)'
 ]
 
+// upper bound of points per series requested from the backend
+const MAX_POINTS = 2000
+
 export default function EconLineChart({ seriesIds = ['GDP'] }){
   const defaultSeries = Array.isArray(seriesIds) && seriesIds.length ? seriesIds[0] : seriesIds
 
@@ -36,7 +39,7 @@ export default function EconLineChart({ seriesIds = ['GDP'] }){
 
   useEffect(() => {
     // fetch any initial series in seriesList
-    seriesList.forEach(id => { if(id) addSeries(id) })
+    loadSeries(seriesList)
     // eslint-disable-next-line react-hooks/exhaustive-deps
   }, [])
 
@@ -48,58 +51,54 @@ export default function EconLineChart({ seriesIds = ['GDP'] }){
     }catch(e){ }
   }, [seriesList, seriesData])
 
-  // helper to recompute labelsRaw as sorted union of all dates across seriesData
-  const rebuildLabelsUnion = (dataMap) => {
-    const set = new Set()
-    Object.values(dataMap).forEach(d => {
-      if(d && d.level) d.level.forEach(pt => set.add(pt.x))
-    })
-    const arr = Array.from(set).map(x => new Date(x)).sort((a,b)=>a-b).map(d=>d.toISOString())
-    setLabelsRaw(arr)
-    // ensure startIndex within bounds
-    setStartIndex(s => Math.max(0, Math.min(s, Math.max(0, arr.length-1))))
-  }
-
-  // fetch and register a series (used for Add)
-  async function addSeries(id){
-    if(!id) return
-    const key = id.trim().toUpperCase()
-    if(seriesData[key]) return // already have it
+  // fetch a set of series in one request. The backend returns them aligned:
+  // a shared date axis plus one value array per column
+  async function loadSeries(ids){
+    const keys = Array.from(new Set(ids.filter(Boolean).map(x => x.trim().toUpperCase())))
+    if(!keys.length){
+      setSeriesList([]); setSeriesData({}); setLabelsRaw([]); setStartIndex(0)
+      return
+    }
     setLoading(true)
     setError(null)
 
     const BACKEND = import.meta.env.VITE_BACKEND_URL || 'http://localhost:5000'
     try{
-      const resp = await fetch(`${BACKEND}/econdata`, {
+      const resp = await fetch(`${BACKEND}/econdata/aligned`, {
         method: 'POST', headers: { 'Content-Type':'application/json' },
-        body: JSON.stringify({ series_ids: [key] })
+        // long daily series are downsampled on the server, charts hold far fewer pixels
+        body: JSON.stringify({ series_ids: keys, max_points: MAX_POINTS })
       })
       if(!resp.ok) throw new Error(`Server returned ${resp.status}`)
       const json = await resp.json()
-      const payload = json[key]
-      if(!payload || !payload.data) throw new Error('No data returned for ' + key)
-
-      const dataDict = payload.data
-      const meta = (payload.meta && payload.meta.length) ? payload.meta[0] : null
-      const frequency = meta && meta.frequency ? meta.frequency : 'Monthly'
+      const columns = json.data || {}
+
+      const labels = (columns.date || []).map(d => { try { return new Date(d).toISOString() } catch(e){ return d } })
+      // skip the gaps left by the alignment so lower frequency series still draw as lines
+      const toPoints = (arr) => {
+        const pts = []
+        if(!arr) return pts
+        labels.forEach((x, i) => { if(arr[i] !== null && arr[i] !== undefined) pts.push({ x, y: arr[i] }) })
+        return pts
+      }
 
-      const labels = dataDict.date || []
-      const toPoints = (arr) => labels.map((d,i) => {
-        const val = (arr && arr[i] !== undefined) ? arr[i] : null
-        const iso = (() => { try { return new Date(d).toISOString() } catch(e){ return d } })()
-        return { x: iso, y: val }
+      const next = {}
+      keys.forEach(key => {
+        if(!columns[key]) return
+        const metaList = json.meta && json.meta[key]
+        const meta = (metaList && metaList.length) ? metaList[0] : null
+        const frequency = meta && meta.frequency ? meta.frequency : 'Monthly'
+        const periodKey = (frequency && frequency.toLowerCase().startsWith('q')) ? `QoQ_${key}` : `MoM_${key}`
+        next[key] = { level: toPoints(columns[key]), period: toPoints(columns[periodKey]), yoy: toPoints(columns[`YoY_${key}`]), freq: frequency }
       })
 
-      const lvl = toPoints(dataDict[key] || [])
-      const periodKey = (frequency && frequency.toLowerCase().startsWith('q')) ? `QoQ_${key}` : `MoM_${key}`
-      const period = toPoints(dataDict[periodKey] || [])
-      const yoy = toPoints(dataDict[`YoY_${key}`] || [])
-
-      const next = { ...seriesData, [key]: { level: lvl, period, yoy, freq: frequency } }
+      const missing = keys.filter(k => !next[k])
       setSeriesData(next)
-      // ensure id present in list
-      setSeriesList(prev => prev.includes(key) ? prev : [...prev, key])
-      rebuildLabelsUnion(next)
+      setSeriesList(keys.filter(k => next[k]))
+      setLabelsRaw(labels)
+      // ensure startIndex within bounds
+      setStartIndex(s => Math.max(0, Math.min(s, Math.max(0, labels.length-1))))
+      if(missing.length) setError('No data returned for ' + missing.join(', '))
       setLoading(false)
     }catch(err){
       setError(err.message)
@@ -107,17 +106,18 @@ export default function EconLineChart({ seriesIds = ['GDP'] }){
     }
   }
 
+  // register a series (used for Add), the whole set is requested again so
+  // the date axis stays aligned on the server
+  function addSeries(id){
+    if(!id) return
+    const key = id.trim().toUpperCase()
+    if(seriesData[key]) return // already have it
+    loadSeries([...seriesList, key])
+  }
+
   function removeSeries(id){
     const key = id.trim().toUpperCase()
-    if(!seriesData[key]){
-      setSeriesList(prev => prev.filter(s=>s!==key))
-      return
-    }
-    const next = { ...seriesData }
-    delete next[key]
-    setSeriesData(next)
-    setSeriesList(prev => prev.filter(s=>s!==key))
-    rebuildLabelsUnion(next)
+    loadSeries(seriesList.filter(s=>s!==key))
   }
 
   async function fetchSeries(id){